@@ -0,0 +1,335 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+
+"""
+Benchmarks py-vminfo.py stage by stage without a production vCenter.
+
+By default each inventory size runs against vsphere_standin, an in-process stand-in that answers from synthetic
+inventories and sizes every request and response with pyVmomi's SOAP serializer.  With --vcsim it runs against a
+running govmomi vcsim instead (or any vCenter), counting the bytes that actually cross the socket.
+
+Every run is appended to a JSON lines history file, and --check compares it against the previous run of the same
+target and size so a change that adds round trips, bytes or time shows up offline.
+"""
+
+from __future__ import print_function
+from pyVim.connect import SmartConnect
+from pyVmomi import SoapAdapter, vim
+from contextlib import redirect_stderr, redirect_stdout
+from datetime import datetime
+from io import StringIO
+
+import argparse
+import http.client
+import importlib.util
+import json
+import os
+import platform
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+
+import vsphere_standin
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+
+# VMs timed through the one-VM-per-call BuildQuery path, so the biggest inventories don't take forever
+BUILD_QUERY_SAMPLE = 20
+
+# Names looked up in the find_vms_names stage
+NAME_SAMPLE = 5
+
+
+def GetArgs():
+    """
+    Supports the command-line arguments listed below.
+    """
+    parser = argparse.ArgumentParser(description='Benchmark py-vminfo.py against a local vSphere API stand-in')
+    parser.add_argument('--sizes', default='100,1000,10000', action='store',
+                        help='Comma separated inventory sizes to run against the stand-in (default 100,1000,10000)')
+    parser.add_argument('--vcsim', required=False, action='store', metavar='HOST:PORT',
+                        help='Run once against a vcsim (or vCenter) at HOST:PORT instead of the stand-in')
+    parser.add_argument('-u', '--user', default='user', action='store', help='User for --vcsim')
+    parser.add_argument('-p', '--password', default='pass', action='store', help='Password for --vcsim')
+    parser.add_argument('--no-bytes', required=False, action='store_true',
+                        help='Skip serializing stand-in traffic to count bytes, which is slow for big inventories')
+    parser.add_argument('--history', default=os.path.join(BENCH_DIR, 'history.jsonl'), action='store',
+                        help='JSON lines file the results are appended to')
+    parser.add_argument('--no-record', required=False, action='store_true',
+                        help='Don\'t append this run to the history')
+    parser.add_argument('--check', required=False, action='store_true',
+                        help='Exit non-zero if a stage regressed against the previous run of the same target and size')
+    parser.add_argument('--tolerance', type=float, default=0.25, action='store',
+                        help='Fraction a stage\'s time or bytes may grow by before --check calls it a regression')
+    return parser.parse_args()
+
+
+def LoadVminfo():
+    # The script name has a dash in it, so it is loaded by path, with the repo on the path for vmstats.py
+    if REPO_DIR not in sys.path:
+        sys.path.insert(0, REPO_DIR)
+    spec = importlib.util.spec_from_file_location('vminfo', os.path.join(REPO_DIR, 'py-vminfo.py'))
+    vminfo = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(vminfo)
+    return vminfo
+
+
+class WireMeter(vsphere_standin.Meter):
+    """
+    Meter for a real endpoint: round trips are counted at the SOAP stub, bytes at the HTTP connection, so gzip and
+    headers are included.
+    """
+
+    def Install(self):
+        meter = self
+        invokeMethod = SoapAdapter.SoapStubAdapter.InvokeMethod
+        send = http.client.HTTPConnection.send
+        read = http.client.HTTPResponse.read
+
+        def CountedInvokeMethod(stub, *args, **kwargs):
+            meter.Record(0, 0)
+            return invokeMethod(stub, *args, **kwargs)
+
+        def CountedSend(connection, data):
+            with meter.lock:
+                meter.bytesSent += len(data)
+            return send(connection, data)
+
+        def CountedRead(response, *args):
+            data = read(response, *args)
+            with meter.lock:
+                meter.bytesReceived += len(data)
+            return data
+
+        SoapAdapter.SoapStubAdapter.InvokeMethod = CountedInvokeMethod
+        http.client.HTTPConnection.send = CountedSend
+        http.client.HTTPResponse.read = CountedRead
+
+
+class Bench(object):
+    """
+    Runs the stages of one benchmark and keeps what the meter saw during each.
+    """
+
+    def __init__(self, meter):
+        self.meter = meter
+        self.stages = {}
+
+    def Stage(self, name, function, *args):
+        before = self.meter.Snapshot()
+        started = time.time()
+        result = function(*args)
+        seconds = time.time() - started
+        after = self.meter.Snapshot()
+        stage = dict((key, after[key] - before[key]) for key in after)
+        stage['seconds'] = seconds
+        # Time spent inside the stand-in (building and serializing answers) isn't the tool's own time
+        stage['client_seconds'] = seconds - stage.pop('standin_seconds')
+        self.stages[name] = stage
+        return result
+
+
+def RunStages(vminfo, si, meter, mainArgs):
+    bench = Bench(meter)
+    content = bench.Stage('retrieve_content', si.RetrieveContent)
+    vchtime = bench.Stage('current_time', si.CurrentTime)
+    counter_names = [counter_name for counter_name, instance in vminfo.VM_COUNTERS]
+    perf_dict = bench.Stage('perf_counters', vminfo.GetPerfDict, content, counter_names, 'bench', None)
+    found = bench.Stage('find_vms_glob', vminfo.FindVms, content, '*')
+    names = ','.join(vm.name for vm in found[:NAME_SAMPLE])
+    bench.Stage('find_vms_names', vminfo.FindVms, content, names)
+    bench.Stage('get_properties', vminfo.GetProperties, content, [vim.VirtualMachine],
+                ['name', 'runtime.powerState'], vim.VirtualMachine)
+    vms = [vm.moref for vm in found if vm.powerState == 'poweredOn']
+    properties = bench.Stage('prefetch_properties', vminfo.PrefetchProperties, content, vms,
+                             vminfo.VM_PROPERTIES, vminfo.HOST_PROPERTIES)
+
+    metricIds = vminfo.VmMetricIds(perf_dict)
+
+    def BuildQueries():
+        for vm in vms[:BUILD_QUERY_SAMPLE]:
+            vminfo.BuildQuery(content, vchtime, metricIds, vm, 15)
+    bench.Stage('build_query_x{}'.format(BUILD_QUERY_SAMPLE), BuildQueries)
+
+    def CollectAll():
+        sessionPool = vminfo.SessionPool([content])
+        chunkSize = vminfo.GetChunkSize(content, 0, len(metricIds))
+        metrics = {}
+        for chunkStart in range(0, len(vms), chunkSize):
+            metrics.update(vminfo.CollectVms(sessionPool, vchtime, metricIds, vms[chunkStart:chunkStart + chunkSize],
+                                             15, perf_dict))
+        return metrics
+    metrics = bench.Stage('collect_vms', CollectAll)
+
+    def Render():
+        out = StringIO()
+        for vm in vms:
+            if vm in metrics:
+                vminfo.PrintVmInfo(vminfo.VmRecord(vm, content, vchtime, 15, perf_dict, properties, metrics[vm]), out)
+        return out
+    bench.Stage('render', Render)
+
+    bench.Stage('main', RunMain, vminfo, mainArgs)
+    bench.Stage('main_loose_session_cache', CheckLooseSessionCache, vminfo, mainArgs)
+    # Four hours are read from the 5 minute rollup, where the level 2 counters aren't kept
+    bench.Stage('main_rollup', RunMain, vminfo, mainArgs + ['-i', '240'])
+    # Last, as --profile wraps the stub for the rest of the process
+    bench.Stage('main_profile', CheckProfile, vminfo, mainArgs)
+    return len(found), bench.stages
+
+
+def RunMain(vminfo, mainArgs):
+    argv = sys.argv
+    sys.argv = ['py-vminfo.py'] + mainArgs
+    try:
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull), redirect_stderr(devnull):
+            return vminfo.main()
+    finally:
+        sys.argv = argv
+
+
+def CheckProfile(vminfo, mainArgs):
+    RunMain(vminfo, mainArgs + ['--profile'])
+    if not vminfo.PROFILE.methods:
+        raise RuntimeError('--profile didn\'t see any calls')
+
+
+def CheckLooseSessionCache(vminfo, mainArgs):
+    # A session cache file the group or others can read is ignored, so the run has to log in normally and write
+    # a fresh owner only file in its place
+    cacheDir = tempfile.mkdtemp()
+    perfCacheDir = vminfo.PERF_CACHE_DIR
+    vminfo.PERF_CACHE_DIR = cacheDir
+    argv = sys.argv
+    try:
+        sys.argv = ['py-vminfo.py'] + mainArgs + ['--session-cache']
+        cache_file = vminfo.SessionCacheFile(vminfo.GetArgs())
+        sys.argv = argv
+        with open(cache_file, 'w') as cache:
+            json.dump({'session': 'stale', 'version': 'stale', 'content': ''}, cache)
+        os.chmod(cache_file, 0o644)
+        rc = RunMain(vminfo, mainArgs + ['--session-cache'])
+        with open(cache_file) as cache:
+            cached = json.load(cache)
+        if rc != 0 or cached['session'] == 'stale' or stat.S_IMODE(os.stat(cache_file).st_mode) != 0o600:
+            raise RuntimeError('A session cache file readable by others didn\'t fall back to a normal login')
+    finally:
+        sys.argv = argv
+        vminfo.PERF_CACHE_DIR = perfCacheDir
+        shutil.rmtree(cacheDir)
+
+
+def RunStandin(vminfo, vmCount, countBytes):
+    meter = vsphere_standin.Meter()
+    si = vsphere_standin.ServiceInstance(vmCount, meter, countBytes)
+    # main() logs in through SmartConnect, so hand it the stand-in instead
+    vminfo.SmartConnect = lambda **kwargs: si
+    vminfo.Disconnect = lambda si: None
+    return RunStages(vminfo, si, meter, ['-s', 'standin', '-u', 'bench', '-p', 'bench', '-m', '*',
+                                         '--no-counter-cache'])
+
+
+def RunVcsim(vminfo, endpoint, user, password):
+    host, port = endpoint.rsplit(':', 1)
+    meter = WireMeter()
+    meter.Install()
+    si = SmartConnect(host=host, port=int(port), user=user, pwd=password, disableSslCertValidation=True)
+    return RunStages(vminfo, si, meter, ['-s', host, '-o', port, '-u', user, '-p', password, '-c', '-m', '*',
+                                         '--no-counter-cache'])
+
+
+def GitCommit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def LoadHistory(path):
+    history = []
+    if os.path.exists(path):
+        with open(path) as historyFile:
+            for line in historyFile:
+                if line.strip():
+                    history.append(json.loads(line))
+    return history
+
+
+def Regressions(result, previous, tolerance):
+    # Round trips are deterministic so any increase counts, bytes and time get some slack for noise
+    found = []
+    for name, stage in result['stages'].items():
+        before = previous['stages'].get(name)
+        if not before:
+            continue
+        if stage['round_trips'] > before['round_trips']:
+            found.append('{}: round trips {} -> {}'.format(name, before['round_trips'], stage['round_trips']))
+        for key in ('bytes_sent', 'bytes_received'):
+            if stage[key] > before[key] * (1 + tolerance) and stage[key] - before[key] > 1024:
+                found.append('{}: {} {} -> {}'.format(name, key, before[key], stage[key]))
+        if stage['client_seconds'] > before['client_seconds'] * (1 + tolerance) and \
+                stage['client_seconds'] - before['client_seconds'] > 0.05:
+            found.append('{}: {:.3f}s -> {:.3f}s'.format(name, before['client_seconds'], stage['client_seconds']))
+    return found
+
+
+def PrintResult(result, previous):
+    print('\n{} with {} VMs (commit {})'.format(result['target'], result['vms'], result['commit']))
+    print('{:<26} {:>11} {:>12} {:>14} {:>10}  {}'.format('Stage', 'Round trips', 'KB sent', 'KB received',
+                                                            'Client secs', 'Previous'))
+    for name, stage in result['stages'].items():
+        before = previous['stages'].get(name) if previous else None
+        print('{:<26} {:>11} {:>12.1f} {:>14.1f} {:>10.3f}  {}'.format(
+            name, stage['round_trips'], stage['bytes_sent'] / 1024.0, stage['bytes_received'] / 1024.0,
+            stage['client_seconds'], '{:.3f}'.format(before['client_seconds']) if before else '-'))
+
+
+def main():
+    args = GetArgs()
+    vminfo = LoadVminfo()
+    history = LoadHistory(args.history)
+    commit = GitCommit()
+    regressions = []
+
+    if args.vcsim:
+        runs = [('vcsim {}'.format(args.vcsim), lambda: RunVcsim(vminfo, args.vcsim, args.user, args.password))]
+    else:
+        runs = [('standin', lambda vmCount=int(size): RunStandin(vminfo, vmCount, not args.no_bytes))
+                for size in args.sizes.split(',') if size.strip()]
+
+    for target, run in runs:
+        vmCount, stages = run()
+        result = {'time': datetime.now().isoformat(), 'commit': commit, 'target': target, 'vms': vmCount,
+                  'bytes_counted': not args.no_bytes, 'python': platform.python_version(), 'stages': stages}
+        previous = None
+        for entry in reversed(history):
+            if entry['target'] == target and entry['vms'] == vmCount and \
+                    entry.get('bytes_counted') == result['bytes_counted']:
+                previous = entry
+                break
+        PrintResult(result, previous)
+        if args.check and previous:
+            regressions += ['{} VMs, {}'.format(vmCount, regression)
+                            for regression in Regressions(result, previous, args.tolerance)]
+        if not args.no_record:
+            with open(args.history, 'a') as historyFile:
+                historyFile.write(json.dumps(result) + '\n')
+            history.append(result)
+
+    if regressions:
+        print('\nRegressions against the previous run:')
+        for regression in regressions:
+            print('  ' + regression)
+        return 1
+    return 0
+
+
+# Start program
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,425 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+
+"""
+In-process stand-in for the parts of the vSphere API that py-vminfo.py uses, for benchmarking without a vCenter.
+
+StandinStub replaces the SOAP stub under a pyVmomi ServiceInstance.  Every call is answered from a synthetic
+inventory of real pyVmomi objects, and the request and response are run through pyVmomi's own SOAP serializer so
+the byte counts are what the same call would put on the wire (before compression).
+"""
+
+from __future__ import print_function
+from pyVmomi import SoapAdapter, VmomiSupport, vim, vmodl
+from pyVmomi.VmomiSupport import newestVersions
+from datetime import datetime, timedelta, timezone
+
+import threading
+import time
+
+VERSION = newestVersions.GetName('vim')
+
+# vCenter clock as seen by the stand-in, on a 20s sample boundary
+NOW = datetime(2026, 1, 1, 12, 0, 0, tzinfo=timezone.utc)
+
+# Objects per RetrievePropertiesEx page and updates per WaitForUpdatesEx call when the caller sets no limit
+DEFAULT_PAGE_SIZE = 100
+
+VMS_PER_HOST = 25
+HOSTS_PER_CLUSTER = 16
+DATASTORES = 8
+MAX_QUERY_METRICS = 64
+
+# Counter catalog: every counter the VM and host reports use, plus some they don't so lookups aren't trivial
+COUNTERS = ['cpu.ready.summation', 'cpu.usage.average', 'cpu.usagemhz.average', 'cpu.demand.average',
+            'mem.active.average', 'mem.shared.average', 'mem.vmmemctl.average', 'mem.swapped.average',
+            'mem.usage.average', 'mem.consumed.average', 'mem.swapused.average',
+            'datastore.numberReadAveraged.average', 'datastore.numberWriteAveraged.average',
+            'datastore.totalReadLatency.average', 'datastore.totalWriteLatency.average',
+            'disk.usage.average', 'net.transmitted.average', 'net.received.average', 'net.usage.average']
+
+# Counters above the default statistics level 1, which the historical intervals below don't keep
+LEVEL_2_COUNTERS = ['mem.swapped.average', 'net.transmitted.average', 'net.received.average']
+
+# vCenter's default historical intervals as (sampling period in seconds, seconds kept, name)
+HISTORICAL_INTERVALS = [(300, 86400, 'Past day'), (1800, 604800, 'Past week'), (7200, 2592000, 'Past month'),
+                        (86400, 31536000, 'Past year')]
+
+
+class Meter(object):
+    """
+    Round trips, bytes each way and time spent inside the stand-in, shared by every stub that reports to it.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.roundTrips = 0
+        self.bytesSent = 0
+        self.bytesReceived = 0
+        self.standinSeconds = 0.0
+
+    def Record(self, sent, received, seconds=0.0):
+        with self.lock:
+            self.roundTrips += 1
+            self.bytesSent += sent
+            self.bytesReceived += received
+            self.standinSeconds += seconds
+
+    def Snapshot(self):
+        with self.lock:
+            return {'round_trips': self.roundTrips, 'bytes_sent': self.bytesSent,
+                    'bytes_received': self.bytesReceived, 'standin_seconds': self.standinSeconds}
+
+
+def Lookup(obj, path):
+    for name in path.split('.'):
+        obj = getattr(obj, name, None)
+        if obj is None:
+            return None
+    return obj
+
+
+class StandinStub(SoapAdapter.SoapStubAdapter):
+    """
+    pyVmomi stub answering from a synthetic inventory of vmCount VMs.  Methods are dispatched on their SOAP name,
+    property reads arrive as Fetch calls like they do on the wire.
+    """
+
+    def __init__(self, vmCount, meter=None, countBytes=True):
+        SoapAdapter.SoapStubAdapter.__init__(self, host='standin', version=VERSION)
+        self.meter = meter or Meter()
+        self.countBytes = countBytes
+        self.lock = threading.Lock()
+        self.now = NOW
+        self.objects = {}
+        self.pages = {}
+        self.collectors = {}
+        self.nextId = 0
+        self.BuildInventory(vmCount)
+
+    def Managed(self, moType, moId, **properties):
+        mo = moType(moId, self)
+        self.objects[moId] = properties
+        return mo
+
+    def NewId(self, prefix):
+        with self.lock:
+            self.nextId += 1
+            return '{}-{}'.format(prefix, self.nextId)
+
+    def BuildInventory(self, vmCount):
+        self.serviceInstance = vim.ServiceInstance('ServiceInstance', self)
+        self.rootFolder = self.Managed(vim.Folder, 'group-d1', name='Datacenters')
+        self.perfManager = self.Managed(vim.PerformanceManager, 'PerfMgr')
+        self.propertyCollector = self.Managed(vmodl.query.PropertyCollector, 'propertyCollector')
+        self.viewManager = self.Managed(vim.view.ViewManager, 'ViewManager')
+        self.settings = self.Managed(vim.option.OptionManager, 'VpxSettings')
+        self.searchIndex = self.Managed(vim.SearchIndex, 'SearchIndex')
+        self.sessionManager = self.Managed(vim.SessionManager, 'SessionManager')
+        self.collectors['propertyCollector'] = {'filters': [], 'version': 0}
+
+        self.counters = []
+        for counterIndex, counter_name in enumerate(COUNTERS):
+            group, name, rollup = counter_name.split('.')
+            self.counters.append(vim.PerformanceManager.CounterInfo(
+                key=counterIndex + 1, groupInfo=vim.ElementDescription(key=group, label=group, summary=group),
+                nameInfo=vim.ElementDescription(key=name, label=name, summary=name),
+                unitInfo=vim.ElementDescription(key='number', label='num', summary='number'),
+                rollupType=rollup, statsType='absolute', level=2 if counter_name in LEVEL_2_COUNTERS else 1))
+        self.objects['PerfMgr']['perfCounter'] = self.counters
+        self.objects['PerfMgr']['historicalInterval'] = [
+            vim.HistoricalInterval(key=intervalIndex + 1, samplingPeriod=samplingPeriod, name=name, length=length,
+                                   level=1, enabled=True)
+            for intervalIndex, (samplingPeriod, length, name) in enumerate(HISTORICAL_INTERVALS)]
+        self.counterNames = dict((counter.key, '{}.{}.{}'.format(counter.groupInfo.key, counter.nameInfo.key,
+                                                                 counter.rollupType)) for counter in self.counters)
+        self.objects['SessionManager']['currentSession'] = vim.UserSession(
+            key='standin-session', userName='bench', fullName='bench', loginTime=NOW, lastActiveTime=NOW,
+            locale='en', messageLocale='en', extensionSession=False)
+        self.content = vim.ServiceInstanceContent(
+            rootFolder=self.rootFolder, propertyCollector=self.propertyCollector, viewManager=self.viewManager,
+            perfManager=self.perfManager, setting=self.settings, searchIndex=self.searchIndex,
+            sessionManager=self.sessionManager,
+            about=vim.AboutInfo(name='VMware vCenter Server', fullName='vSphere stand-in', vendor='VMware',
+                                version='8.0.0', build='1', apiVersion='8.0', apiType='VirtualCenter',
+                                instanceUuid='00000000-0000-0000-0000-00000000be9c', productLineId='vpx',
+                                osType='linux-x64'))
+
+        self.datastores = ['datastore-{}'.format(number + 1) for number in range(DATASTORES)]
+        self.vms = []
+        self.hosts = []
+        self.clusters = []
+        hostCount = max(1, -(-vmCount // VMS_PER_HOST))
+        for hostIndex in range(hostCount):
+            if hostIndex % HOSTS_PER_CLUSTER == 0:
+                cluster = self.Managed(vim.ClusterComputeResource, 'domain-c{}'.format(len(self.clusters) + 1),
+                                       name='cluster{:03d}'.format(len(self.clusters)), host=[])
+                self.clusters.append(cluster)
+            host = self.Managed(
+                vim.HostSystem, 'host-{}'.format(hostIndex + 1), name='esx{:04d}.bench.local'.format(hostIndex),
+                parent=cluster, vm=[],
+                summary=vim.host.Summary(
+                    hardware=vim.host.Summary.HardwareSummary(
+                        vendor='Bench', model='Stand-in', uuid='host-{}'.format(hostIndex), memorySize=512 * 1024 ** 3,
+                        cpuModel='Intel(R) Xeon(R) Gold 6248 CPU @ 2.50GHz', cpuMhz=2500, numCpuPkgs=2,
+                        numCpuCores=40, numCpuThreads=80, numNics=4, numHBAs=2),
+                    quickStats=vim.host.Summary.QuickStats(overallCpuUsage=20000 + hostIndex * 37 % 30000,
+                                                           overallMemoryUsage=200000 + hostIndex * 53 % 200000)))
+            self.objects[cluster._moId]['host'].append(host)
+            self.hosts.append(host)
+
+        for vmIndex in range(vmCount):
+            host = self.hosts[vmIndex // VMS_PER_HOST]
+            name = 'vm{:05d}'.format(vmIndex)
+            # Every 20th VM is powered off, every 3rd has a snapshot
+            runtime = vim.vm.RuntimeInfo(host=host, connectionState='connected',
+                                         powerState='poweredOff' if vmIndex % 20 == 19 else 'poweredOn')
+            datastore = self.datastores[vmIndex % DATASTORES]
+            devices = [vim.vm.device.VirtualDisk(
+                key=2000 + disk, controllerKey=1000, unitNumber=disk, capacityInKB=(40 + 10 * disk) * 1024 ** 2,
+                deviceInfo=vim.Description(label='Hard disk {}'.format(disk + 1), summary='disk'),
+                backing=vim.vm.device.VirtualDisk.FlatVer2BackingInfo(
+                    fileName='[{}] {}/{}_{}.vmdk'.format(datastore, name, name, disk), diskMode='persistent',
+                    thinProvisioned=disk > 0)) for disk in range(1 + vmIndex % 3)]
+            devices.append(vim.vm.device.VirtualVmxnet3(
+                key=4000, controllerKey=100, unitNumber=7, macAddress='00:50:56:{:02x}:{:02x}:{:02x}'.format(
+                    vmIndex >> 16 & 255, vmIndex >> 8 & 255, vmIndex & 255),
+                deviceInfo=vim.Description(label='Network adapter 1', summary='VM Network')))
+            config = vim.vm.Summary.ConfigSummary(
+                name=name, template=False, vmPathName='[{}] {}/{}.vmx'.format(datastore, name, name),
+                memorySizeMB=4096 * (1 + vmIndex % 4), numCpu=2 * (1 + vmIndex % 4), annotation='Benchmark VM',
+                guestFullName='Ubuntu Linux (64-bit)', uuid='4200{:04x}-0000-0000-0000-{:012x}'.format(
+                    vmIndex & 0xffff, vmIndex), instanceUuid='5000{:04x}-0000-0000-0000-{:012x}'.format(
+                    vmIndex & 0xffff, vmIndex))
+            vm = self.Managed(
+                vim.VirtualMachine, 'vm-{}'.format(vmIndex + 1), name=name, runtime=runtime,
+                summary=vim.vm.Summary(config=config, runtime=runtime, quickStats=vim.vm.Summary.QuickStats(
+                    overallCpuUsage=vmIndex * 13 % 4000, overallCpuDemand=vmIndex * 13 % 4000 + vmIndex * 7 % 500,
+                    swappedMemory=vmIndex * 11 % 97 if vmIndex % 9 == 0 else 0, balloonedMemory=0,
+                    guestMemoryUsage=1024)),
+                resourceConfig=vim.ResourceConfigSpec(
+                    cpuAllocation=vim.ResourceAllocationInfo(limit=-1, reservation=0),
+                    memoryAllocation=vim.ResourceAllocationInfo(limit=-1, reservation=0)),
+                config=vim.vm.ConfigInfo(name=name, hardware=vim.vm.VirtualHardware(
+                    numCPU=config.numCpu, memoryMB=config.memorySizeMB, device=devices)),
+                guest=vim.vm.GuestInfo(hostName=name),
+                rootSnapshot=[vim.vm.Snapshot('snapshot-{}'.format(vmIndex + 1), self)] if vmIndex % 3 == 0 else None)
+            self.objects[host._moId]['vm'].append(vm)
+            self.vms.append(vm)
+        self.vmsByName = dict((self.objects[vm._moId]['name'], vm) for vm in self.vms)
+
+    # Stub interface
+
+    def InvokeMethod(self, mo, info, args, outerStub=None):
+        started = time.time()
+        sent = len(self.SerializeRequest(mo, info, args)) if self.countBytes else 0
+        try:
+            result = getattr(self, info.wsdlName)(mo, *args)
+        except vmodl.MethodFault as fault:
+            self.meter.Record(sent, 0, time.time() - started)
+            raise fault
+        received = 0
+        if self.countBytes and result is not None:
+            received = len(SoapAdapter.Serialize(result, info=VmomiSupport.Object(
+                name='returnval', type=info.result, version=VERSION, flags=info.resultFlags), version=VERSION))
+        self.meter.Record(sent, received, time.time() - started)
+        return result
+
+    # vim.ServiceInstance
+
+    def RetrieveServiceContent(self, mo):
+        return self.content
+
+    def CurrentTime(self, mo):
+        return self.now
+
+    # Property reads (InvokeAccessor turns them into Fetch calls)
+
+    def Fetch(self, mo, prop):
+        return self.objects.get(mo._moId, {}).get(prop)
+
+    # vim.SessionManager and vim.option.OptionManager
+
+    def Logout(self, mo):
+        return None
+
+    def QueryOptions(self, mo, name=None):
+        return [vim.option.OptionValue(key='config.vpxd.stats.maxQueryMetrics', value=MAX_QUERY_METRICS)]
+
+    # vim.view
+
+    def CreateContainerView(self, mo, container, type, recursive):
+        view = self.Managed(vim.view.ContainerView, self.NewId('session[bench]view'))
+        inventory = self.vms + self.hosts + self.clusters
+        self.objects[view._moId]['view'] = [obj for obj in inventory if any(isinstance(obj, viewType)
+                                                                            for viewType in type)]
+        return view
+
+    def DestroyView(self, mo):
+        self.objects.pop(mo._moId, None)
+        return None
+
+    # vim.SearchIndex
+
+    def FindAllByDnsName(self, mo, datacenter, dnsName, vmSearch):
+        vm = self.vmsByName.get(dnsName)
+        return [vm] if vm is not None and vmSearch else []
+
+    def FindAllByUuid(self, mo, datacenter, uuid, vmSearch, instanceUuid=None):
+        key = 'instanceUuid' if instanceUuid else 'uuid'
+        return [vm for vm in self.vms if getattr(self.objects[vm._moId]['summary'].config, key) == uuid]
+
+    # vmodl.query.PropertyCollector
+
+    def Resolve(self, filterSpec):
+        # The objects a filter spec selects: each ObjectSpec's object plus one level of traversal
+        resolved = []
+        for objectSpec in filterSpec.objectSet:
+            found = [] if objectSpec.skip else [objectSpec.obj]
+            for selection in objectSpec.selectSet or []:
+                if isinstance(selection, vmodl.query.PropertyCollector.TraversalSpec) and \
+                        isinstance(objectSpec.obj, selection.type):
+                    value = Lookup(_Properties(self.objects.get(objectSpec.obj._moId, {})), selection.path)
+                    found += value if isinstance(value, list) else [value] if value is not None else []
+            resolved += found
+        seen = set()
+        return [obj for obj in resolved if not (obj._moId in seen or seen.add(obj._moId))]
+
+    def ObjectContents(self, filterSpecs):
+        contents = []
+        for filterSpec in filterSpecs:
+            for obj in self.Resolve(filterSpec):
+                properties = _Properties(self.objects.get(obj._moId, {}))
+                for propertySpec in filterSpec.propSet:
+                    if isinstance(obj, propertySpec.type):
+                        propSet = [vmodl.DynamicProperty(name=path, val=Typed(value)) for path, value in
+                                   ((path, Lookup(properties, path)) for path in propertySpec.pathSet)
+                                   if value is not None]
+                        contents.append(vmodl.query.PropertyCollector.ObjectContent(obj=obj, propSet=propSet))
+        return contents
+
+    def Page(self, contents, pageSize):
+        page, rest = contents[:pageSize], contents[pageSize:]
+        token = None
+        if rest:
+            token = self.NewId('token')
+            self.pages[token] = (rest, pageSize)
+        return vmodl.query.PropertyCollector.RetrieveResult(token=token, objects=page)
+
+    def RetrievePropertiesEx(self, mo, specSet, options):
+        contents = self.ObjectContents(specSet)
+        if not contents:
+            return None
+        return self.Page(contents, options.maxObjects or DEFAULT_PAGE_SIZE)
+
+    def ContinueRetrievePropertiesEx(self, mo, token):
+        contents, pageSize = self.pages.pop(token)
+        return self.Page(contents, pageSize)
+
+    def RetrieveContents(self, mo, specSet):
+        return self.ObjectContents(specSet)
+
+    def CreatePropertyCollector(self, mo):
+        collector = self.Managed(vmodl.query.PropertyCollector, self.NewId('session[bench]pc'))
+        self.collectors[collector._moId] = {'filters': [], 'pending': None, 'version': 0}
+        return collector
+
+    def DestroyPropertyCollector(self, mo):
+        self.collectors.pop(mo._moId, None)
+        return None
+
+    def CreateFilter(self, mo, spec, partialUpdates):
+        self.collectors[mo._moId]['filters'].append(spec)
+        return self.Managed(vmodl.query.PropertyCollector.Filter, self.NewId('session[bench]filter'))
+
+    def DestroyPropertyFilter(self, mo):
+        return None
+
+    def WaitForUpdatesEx(self, mo, version=None, options=None):
+        # The inventory never changes, so only the first call (and its truncated continuations) has updates
+        collector = self.collectors[mo._moId]
+        if not version:
+            collector['pending'] = [
+                vmodl.query.PropertyCollector.ObjectUpdate(kind='enter', obj=content.obj, changeSet=[
+                    vmodl.query.PropertyCollector.Change(name=prop.name, op='assign', val=prop.val)
+                    for prop in content.propSet]) for content in self.ObjectContents(collector['filters'])]
+        pending = collector['pending']
+        if not pending:
+            return None
+        pageSize = (options and options.maxObjectUpdates) or DEFAULT_PAGE_SIZE
+        collector['pending'] = pending[pageSize:]
+        collector['version'] += 1
+        return vmodl.query.PropertyCollector.UpdateSet(
+            version=str(collector['version']), truncated=bool(collector['pending']),
+            filterSet=[vmodl.query.PropertyCollector.FilterUpdate(
+                filter=vmodl.query.PropertyCollector.Filter('session[bench]filter', self), objectSet=pending[:pageSize])])
+
+    # vim.PerformanceManager
+
+    def QueryPerfCounter(self, mo, counterId):
+        return [counter for counter in self.counters if counter.key in counterId]
+
+    def QueryPerf(self, mo, querySpec):
+        metrics = []
+        for spec in querySpec:
+            if not isinstance(spec.entity, (vim.VirtualMachine, vim.HostSystem)):
+                continue
+            properties = self.objects[spec.entity._moId]
+            if isinstance(spec.entity, vim.VirtualMachine) and properties['runtime'].powerState != 'poweredOn':
+                continue
+            step = spec.intervalId or 20
+            endTime = min(spec.endTime or self.now, self.now)
+            startTime = spec.startTime or endTime - timedelta(hours=1)
+            timestamps = []
+            timestamp = endTime - timedelta(seconds=int((endTime - NOW).total_seconds()) % step)
+            while timestamp > startTime:
+                timestamps.insert(0, timestamp)
+                timestamp -= timedelta(seconds=step)
+            if spec.maxSample:
+                timestamps = timestamps[-spec.maxSample:]
+            if not timestamps:
+                continue
+            seed = int(spec.entity._moId.split('-')[-1])
+            series = []
+            for metricId in spec.metricId or []:
+                if step != 20 and self.counterNames[metricId.counterId] in LEVEL_2_COUNTERS:
+                    # The historical intervals are at level 1, so these counters have no rollup samples
+                    continue
+                if metricId.instance == '*' and self.counterNames[metricId.counterId].startswith('datastore.'):
+                    instances = self.datastores[seed % DATASTORES:seed % DATASTORES + 1 + seed % 2]
+                else:
+                    instances = [metricId.instance if metricId.instance != '*' else '']
+                for instance in instances:
+                    series.append(vim.PerformanceManager.IntSeries(
+                        id=vim.PerformanceManager.MetricId(counterId=metricId.counterId, instance=instance),
+                        value=[SampleValue(seed, metricId.counterId, instance, stamp) for stamp in timestamps]))
+            metrics.append(vim.PerformanceManager.EntityMetric(
+                entity=spec.entity, value=series,
+                sampleInfo=[vim.PerformanceManager.SampleInfo(timestamp=stamp, interval=step)
+                            for stamp in timestamps]))
+        return metrics
+
+
+class _Properties(object):
+    # Lets Lookup walk the top level of an object's property dictionary like a data object
+    def __init__(self, properties):
+        self.__dict__.update(properties)
+
+
+def Typed(value):
+    # Inventory lists are kept as plain lists, the serializer needs them as typed arrays
+    if type(value) is list:
+        return (type(value[0]) if value else vmodl.ManagedObject).Array(value)
+    return value
+
+
+def SampleValue(seed, counterId, instance, timestamp):
+    # Deterministic and different per VM and counter, so rankings and averages have something to work on
+    tick = int((timestamp - NOW).total_seconds()) // 20
+    return (seed * 7919 + counterId * 104729 + len(instance) * 31 + tick * 17) % (50 + seed % 1950)
+
+
+def ServiceInstance(vmCount, meter=None, countBytes=True):
+    stub = StandinStub(vmCount, meter, countBytes)
+    return stub.serviceInstance
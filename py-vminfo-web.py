@@ -6,132 +6,43 @@
 Python program that generates various statistics for one or more virtual machines
 
 A list of virtual machines can be provided as a comma separated list.
+
+Runs as a CGI script when started by a web server, or as a long running WSGI server with --serve that keeps
+its vCenter session and perf counter map between requests.
 """
 
 from __future__ import print_function
 from pyVim.connect import SmartConnect, Disconnect
 from pyVmomi import vmodl, vim
-from datetime import timedelta, datetime
-
+from collections import OrderedDict
+from concurrent.futures import Future
+from datetime import timedelta, datetime, timezone
+from functools import partial
+from io import StringIO
+from urllib.parse import parse_qs
+from wsgiref.handlers import CGIHandler
+from wsgiref.simple_server import make_server
+
+import argparse
 import atexit
 import getpass
-import cgi
+import os
+import threading
 import viconfig
+import vmstats
 import ssl
 
-form = cgi.FieldStorage()
-print("Content-Type: text/html;charset=utf-8\n\n")
-
-
-def BuildQuery(content, vchtime, counterId, instance, vm, interval):
-    perfManager = content.perfManager
-    metricId = vim.PerformanceManager.MetricId(counterId=counterId, instance=instance)
-    startTime = vchtime - timedelta(minutes=(interval + 1))
-    endTime = vchtime - timedelta(minutes=1)
-    query = vim.PerformanceManager.QuerySpec(intervalId=20, entity=vm, metricId=[metricId], startTime=startTime,
-                                             endTime=endTime)
-    perfResults = perfManager.QueryPerf(querySpec=[query])
-    if perfResults:
-        return perfResults
-    else:
-        print('ERROR: Performance results empty.  TIP: Check time drift on source and vCenter server')
-        print('Troubleshooting info:')
-        print('vCenter/host date and time: {}'.format(vchtime))
-        print('Start perf counter time   :  {}'.format(startTime))
-        print('End perf counter time     :  {}'.format(endTime))
-        print(query)
-        exit()
-
-
-def html_table(vm_property, vm_value):
-    print('<tr>')
-    print('<td width="40%"><b>' + vm_property + '</b></td>')
-    print('<td width="60%">' + str(vm_value) + '</td>')
-    print('</tr>')
-
-
-
-def PrintVmInfo(vm, content, vchtime, interval, perf_dict):
-    statInt = interval * 3  # There are 3 20s samples in each minute
-    summary = vm.summary
-    disk_list = []
-    network_list = []
-
-    # Convert limit and reservation values from -1 to None
-    if vm.resourceConfig.cpuAllocation.limit == -1:
-        vmcpulimit = "None"
-    else:
-        vmcpulimit = "{} Mhz".format(vm.resourceConfig.cpuAllocation.limit)
-    if vm.resourceConfig.memoryAllocation.limit == -1:
-        vmmemlimit = "None"
-    else:
-        vmmemlimit = "{} MB".format(vm.resourceConfig.memoryAllocation.limit)
-
-    if vm.resourceConfig.cpuAllocation.reservation == 0:
-        vmcpures = "None"
-    else:
-        vmcpures = "{} Mhz".format(vm.resourceConfig.cpuAllocation.reservation)
-    if vm.resourceConfig.memoryAllocation.reservation == 0:
-        vmmemres = "None"
-    else:
-        vmmemres = "{} MB".format(vm.resourceConfig.memoryAllocation.reservation)
-
-    vm_hardware = vm.config.hardware
-    for each_vm_hardware in vm_hardware.device:
-        if (each_vm_hardware.key >= 2000) and (each_vm_hardware.key < 3000):
-            disk_list.append('{} | {:.1f}GB | Thin: {} | {}'.format(each_vm_hardware.deviceInfo.label,
-                                                         each_vm_hardware.capacityInKB/1024/1024,
-                                                         each_vm_hardware.backing.thinProvisioned,
-                                                         each_vm_hardware.backing.fileName))
-        elif (each_vm_hardware.key >= 4000) and (each_vm_hardware.key < 5000):
-            network_list.append('{} | {} | {}'.format(each_vm_hardware.deviceInfo.label,
-                                                         each_vm_hardware.deviceInfo.summary,
-                                                         each_vm_hardware.macAddress))
-
-    disk_output = '<br/>'.join(disk_list)
-    network_output = '<br/>'.join(network_list)
-
-    #CPU Ready Average
-    statCpuReady = BuildQuery(content, vchtime, (StatCheck(perf_dict, 'cpu.ready.summation')), "", vm, interval)
-    cpuReady = (float(sum(statCpuReady[0].value[0].value)) / statInt)
-    #CPU Usage Average % - NOTE: values are type LONG so needs divided by 100 for percentage
-    statCpuUsage = BuildQuery(content, vchtime, (StatCheck(perf_dict, 'cpu.usage.average')), "", vm, interval)
-    cpuUsage = ((float(sum(statCpuUsage[0].value[0].value)) / statInt) / 100)
-    #Memory Active Average MB
-    statMemoryActive = BuildQuery(content, vchtime, (StatCheck(perf_dict, 'mem.active.average')), "", vm, interval)
-    memoryActive = (float(sum(statMemoryActive[0].value[0].value) / 1024) / statInt)
-    #Memory Shared
-    statMemoryShared = BuildQuery(content, vchtime, (StatCheck(perf_dict, 'mem.shared.average')), "", vm, interval)
-    memoryShared = (float(sum(statMemoryShared[0].value[0].value) / 1024) / statInt)
-    #Memory Balloon
-    statMemoryBalloon = BuildQuery(content, vchtime, (StatCheck(perf_dict, 'mem.vmmemctl.average')), "", vm, interval)
-    memoryBalloon = (float(sum(statMemoryBalloon[0].value[0].value) / 1024) / statInt)
-    #Memory Swapped
-    statMemorySwapped = BuildQuery(content, vchtime, (StatCheck(perf_dict, 'mem.swapped.average')), "", vm, interval)
-    memorySwapped = (float(sum(statMemorySwapped[0].value[0].value) / 1024) / statInt)
-    #Datastore Average IO
-    statDatastoreIoRead = BuildQuery(content, vchtime, (StatCheck(perf_dict, 'datastore.numberReadAveraged.average')),
-                                     "*", vm, interval)
-    DatastoreIoRead = (float(sum(statDatastoreIoRead[0].value[0].value)) / statInt)
-    statDatastoreIoWrite = BuildQuery(content, vchtime, (StatCheck(perf_dict, 'datastore.numberWriteAveraged.average')),
-                                      "*", vm, interval)
-    DatastoreIoWrite = (float(sum(statDatastoreIoWrite[0].value[0].value)) / statInt)
-    #Datastore Average Latency
-    statDatastoreLatRead = BuildQuery(content, vchtime, (StatCheck(perf_dict, 'datastore.totalReadLatency.average')),
-                                      "*", vm, interval)
-    DatastoreLatRead = (float(sum(statDatastoreLatRead[0].value[0].value)) / statInt)
-    statDatastoreLatWrite = BuildQuery(content, vchtime, (StatCheck(perf_dict, 'datastore.totalWriteLatency.average')),
-                                       "*", vm, interval)
-    DatastoreLatWrite = (float(sum(statDatastoreLatWrite[0].value[0].value)) / statInt)
-
-    #Network usage (Tx/Rx)
-    statNetworkTx = BuildQuery(content, vchtime, (StatCheck(perf_dict, 'net.transmitted.average')), "", vm, interval)
-    networkTx = (float(sum(statNetworkTx[0].value[0].value) * 8 / 1024) / statInt)
-    statNetworkRx = BuildQuery(content, vchtime, (StatCheck(perf_dict, 'net.received.average')), "", vm, interval)
-    networkRx = (float(sum(statNetworkRx[0].value[0].value) * 8 / 1024) / statInt)
+from vmstats import (BuildQuery, FetchStoredStats, Figure, GetPerfDict, HOST_PROPERTIES, PERF_CACHE_DIR,
+                     PrefetchProperties, ReduceStats, SampleNote, SamplePeriod, SampleStore, SplitPerfResults,
+                     SplitVmNames, ThreadingWSGIServer, ToEpoch, UncollectedCounters, VM_COUNTERS, VM_PROPERTIES,
+                     VmIndex, VmMetricIds)
 
+# Keep-alive connections the vCenter session keeps open, so this many concurrent --serve requests don't need a new
+# TCP and TLS handshake each (pyVmomi keeps 5 by default)
+CONNECTION_POOL_SIZE = 16
 
-    print('''\
+# Sent once at the top of every report, before any vCenter call, so the browser has the page shell straight away
+REPORT_STYLE = '''\
         <style>
         p {
             font-family: Verdana, Geneva, sans-serif;
@@ -159,148 +70,426 @@ def PrintVmInfo(vm, content, vchtime, interval, perf_dict):
             background-color: #EFF5FB;
         }
         </style>
-    ''')
+'''
+
+# Number of rendered reports the --serve response cache keeps
+REPORT_CACHE_SIZE = 128
+
+# Page served when no vmname is given
+LAUNCH_PAGE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'vminfo-launch.html')
+
+
+def html_table(out, vm_property, vm_value):
+    print('<tr>', file=out)
+    print('<td width="40%"><b>' + vm_property + '</b></td>', file=out)
+    print('<td width="60%">' + str(vm_value) + '</td>', file=out)
+    print('</tr>', file=out)
 
-    print('<table>')
 
-    print('<p>NOTE: Any VM statistics are averages of the last {} minutes<p>'.format(statInt / 3))
-    print('<p>Core Information</p>')
-    html_table('Virtual Machine Name', '<b> {} </b>'.format(summary.config.name))
-    html_table('Description', summary.config.annotation)
-    html_table('Guest', summary.config.guestFullName)
-    if vm.rootSnapshot:
-        html_table('Snapshot Status', 'Snapshot(s) found')
+def PrintVmInfo(vm, content, vchtime, interval, perf_dict, properties, store=None):
+    # Generator of the VM's HTML in two chunks: the sections that only need the prefetched properties, then the rest
+    # once its perf query is done
+    out = StringIO()
+    samplingPeriod = SamplePeriod(interval)
+    vmSnapshot = properties[vm]
+    hostSnapshot = properties[vmSnapshot.host]
+
+    # Convert limit and reservation values from -1 to None
+    if vmSnapshot.cpuLimit == -1:
+        vmcpulimit = "None"
+    else:
+        vmcpulimit = "{} Mhz".format(vmSnapshot.cpuLimit)
+    if vmSnapshot.memLimit == -1:
+        vmmemlimit = "None"
+    else:
+        vmmemlimit = "{} MB".format(vmSnapshot.memLimit)
+
+    if vmSnapshot.cpuReservation == 0:
+        vmcpures = "None"
+    else:
+        vmcpures = "{} Mhz".format(vmSnapshot.cpuReservation)
+    if vmSnapshot.memReservation == 0:
+        vmmemres = "None"
     else:
-        html_table('Snapshot Status', 'No Snapshots')
-    html_table('VM .vmx Path', summary.config.vmPathName)
-    html_table('Virtual Disks', disk_output)
-    html_table('Virtual NIC(s)', network_output)
-    print('</table>')
-    print('<p>vCPU and Memory Information</p>')
-    print('<table>')
-    html_table('[VM] Limits', 'CPU: {}, Memory: {}'.format(vmcpulimit, vmmemlimit))
-    html_table('[VM] Reservations', 'CPU: {}, Memory: {}'.format(vmcpures, vmmemres))
-    html_table('[VM] Number of vCPUs', summary.config.numCpu)
-    html_table('[VM] CPU Ready', 'Average {:.1f} %, Maximum {:.1f} %'.format((cpuReady / 20000 * 100),
-                                                                             ((float(max(statCpuReady[0].value[0]
-                                                                                         .value)) / 20000 * 100))))
-    html_table('[VM] CPU (%)', '{:.0f} %'.format(cpuUsage))
-    html_table('[VM] Memory', '{} MB ({:.1f} GB)'.format(summary.config.memorySizeMB,
-                                                         (float(summary.config.memorySizeMB) / 1024)))
-    html_table('[VM] Memory Shared', '{:.0f} %, {:.0f} MB'.format(((memoryShared / summary.config.memorySizeMB) * 100),
-                                                                  memoryShared))
-    html_table('[VM] Memory Balloon', '{:.0f} %, {:.0f} MB'.format(((memoryBalloon / summary.config.memorySizeMB)
-                                                                    * 100), memoryBalloon))
-    html_table('[VM] Memory Swapped', '{:.0f} %, {:.0f} MB'.format(((memorySwapped / summary.config.memorySizeMB)
-                                                                    * 100), memorySwapped))
-    html_table('[VM] Memory Active', '{:.0f} %, {:.0f} MB'.format(((memoryActive / summary.config.memorySizeMB) * 100),
-                                                                  memoryActive))
-    print('</table>')
-    print('<p>Datastore and Network Information</p>')
-    print('<table>')
-    html_table('[VM] Datastore Average IO', 'Read: {:.0f} IOPS, Write: {:.0f} IOPS'.format(DatastoreIoRead,
-                                                                                           DatastoreIoWrite))
-    html_table('[VM] Datastore Average Latency', 'Read: {:.0f} ms, Write: {:.0f} ms'.format(DatastoreLatRead,
-                                                                                            DatastoreLatWrite))
-    html_table('[VM] Overall Network Usage', 'Transmitted {:.3f} Mbps, Received {:.3f} Mbps'.format(networkTx, networkRx))
-    print('</table>')
-    print('<p>Parent Host Information</p>')
-    print('<table>')
-    html_table('[Host] Name', summary.runtime.host.name)
-    html_table('[Host] CPU Detail', 'Processor Sockets: {}, Cores per Socket {}'.format(
-        summary.runtime.host.summary.hardware.numCpuPkgs,
-        (summary.runtime.host.summary.hardware.numCpuCores / summary.runtime.host.summary.hardware.numCpuPkgs)))
-    html_table('[Host] CPU Type', summary.runtime.host.summary.hardware.cpuModel)
-    html_table('[Host] CPU Usage', 'Used: {} Mhz, Total: {} Mhz'.format(
-        summary.runtime.host.summary.quickStats.overallCpuUsage,
-        (summary.runtime.host.summary.hardware.cpuMhz * summary.runtime.host.summary.hardware.numCpuCores)))
-    html_table('[Host] Memory Usage ', 'Used: {:.0f} GB, Total: {:.0f} GB\n'.format(
-        (float(summary.runtime.host.summary.quickStats.overallMemoryUsage) / 1024),
-        (float(summary.runtime.host.summary.hardware.memorySize) / 1024 / 1024 / 1024)))
-
-    print('</table>')
-
-
-def StatCheck(perf_dict, counter_name):
-    counter_key = perf_dict[counter_name]
-    return counter_key
-
-
-def GetProperties(content, viewType, props, specType):
-    # Build a view and get basic properties for all Virtual Machines
-    objView = content.viewManager.CreateContainerView(content.rootFolder, viewType, True)
-    tSpec = vim.PropertyCollector.TraversalSpec(name='tSpecName', path='view', skip=False, type=vim.view.ContainerView)
-    pSpec = vim.PropertyCollector.PropertySpec(all=False, pathSet=props, type=specType)
-    oSpec = vim.PropertyCollector.ObjectSpec(obj=objView, selectSet=[tSpec], skip=False)
-    pfSpec = vim.PropertyCollector.FilterSpec(objectSet=[oSpec], propSet=[pSpec], reportMissingObjectsInResults=False)
-    retOptions = vim.PropertyCollector.RetrieveOptions()
-    totalProps = []
-    retProps = content.propertyCollector.RetrievePropertiesEx(specSet=[pfSpec], options=retOptions)
-    totalProps += retProps.objects
-    while retProps.token:
-        retProps = content.propertyCollector.ContinueRetrievePropertiesEx(token=retProps.token)
-        totalProps += retProps.objects
-    objView.Destroy()
-    # Turn the output in retProps into a usable dictionary of values
-    gpOutput = []
-    for eachProp in totalProps:
-        propDic = {}
-        for prop in eachProp.propSet:
-            propDic[prop.name] = prop.val
-        propDic['moref'] = eachProp.obj
-        gpOutput.append(propDic)
-    return gpOutput
+        vmmemres = "{} MB".format(vmSnapshot.memReservation)
 
+    disk_list = ['{} | {:.1f}GB | Thin: {} | {}'.format(disk.label, disk.capacityKb / 1024 / 1024, disk.thin,
+                                                        disk.fileName) for disk in vmSnapshot.disks]
+    network_list = ['{} | {} | {}'.format(nic.label, nic.network, nic.mac) for nic in vmSnapshot.nics]
 
-def main():
-    args = viconfig.GetArgs()
-    try:
-        vmnames = form['vmname'].value
-        si = None
-        if args['password']:
-            password = args['password']
-        else:
-            password = getpass.getpass(prompt="Enter password for host {} and user {}: ".format(args['host'], args['user']))
-        try:
-            context = ssl._create_unverified_context()
-            si = SmartConnect(host=args['host'],
-                user=args['user'],
-                pwd=password,
-                port=int(args['port']),
-                sslContext=context)
-        except IOError as e:
-            pass
-        if not si:
-            print('Could not connect to the specified host using specified username and password')
-            return -1
-
-        atexit.register(Disconnect, si)
-        content = si.RetrieveContent()
-        # Get vCenter date and time for use as baseline when querying for counters
-        vchtime = si.CurrentTime()
+    disk_output = '<br/>'.join(disk_list)
+    network_output = '<br/>'.join(network_list)
 
-        # Get all the performance counters
-        perf_dict = {}
-        perfList = content.perfManager.perfCounter
-        for counter in perfList:
-            counter_full = "{}.{}.{}".format(counter.groupInfo.key, counter.nameInfo.key, counter.rollupType)
-            perf_dict[counter_full] = counter.key
+    print('<table>', file=out)
 
-        retProps = GetProperties(content, [vim.VirtualMachine], ['name', 'runtime.powerState'], vim.VirtualMachine)
+    print('<p>NOTE: Any VM statistics are averages of the last {} minutes{}<p>'.format(float(interval),
+                                                                                  SampleNote(interval)), file=out)
+    print('<p>Core Information</p>', file=out)
+    html_table(out, 'Virtual Machine Name', '<b> {} </b>'.format(vmSnapshot.name))
+    html_table(out, 'Description', vmSnapshot.annotation)
+    html_table(out, 'Guest', vmSnapshot.guestFullName)
+    if vmSnapshot.hasSnapshot:
+        html_table(out, 'Snapshot Status', 'Snapshot(s) found')
+    else:
+        html_table(out, 'Snapshot Status', 'No Snapshots')
+    html_table(out, 'VM .vmx Path', vmSnapshot.vmPathName)
+    html_table(out, 'Virtual Disks', disk_output)
+    html_table(out, 'Virtual NIC(s)', network_output)
+    print('</table>', file=out)
+    yield out.getvalue()
+    out = StringIO()
+
+    #Fetch every counter in one QueryPerf call and reduce the series.  With a sample store only the samples it
+    #doesn't already have are queried, after the core information has gone out like without one
+    if store:
+        stats = FetchStoredStats(content, store, vchtime, VmMetricIds(perf_dict), [vm], interval)[vm]
+    else:
+        stats = SplitPerfResults(BuildQuery(content, vchtime, VmMetricIds(perf_dict), vm, interval)[0])
+    metrics = ReduceStats([stats], perf_dict)[0]
 
-        #Find VM supplied as arg and use Managed Object Reference (moref) for the PrintVmInfo
-        for vm in retProps:
-            if (vm['name'] in vmnames) and (vm['runtime.powerState'] == "poweredOn"):
-                PrintVmInfo(vm['moref'], content, vchtime, int(form['vminterval'].value), perf_dict)
-            elif vm['name'] in vmnames:
-                print('ERROR: Problem connecting to Virtual Machine.  {} is likely powered off or suspended'.format(vm['name']))
+    #CPU Ready Average - milliseconds of each sample spent ready, as a percentage of the sampling period
+    cpuReady = metrics['cpu.ready.summation']
+    readyScale = 100.0 / (samplingPeriod * 1000)
+    #CPU Usage Average % - NOTE: values are type LONG so needs divided by 100 for percentage
+    cpuUsage = metrics['cpu.usage.average']['mean'] / 100
+    #Memory Active Average MB
+    memoryActive = metrics['mem.active.average']['mean'] / 1024
+    #Memory Shared
+    memoryShared = metrics['mem.shared.average']['mean'] / 1024
+    #Memory Balloon
+    memoryBalloon = metrics['mem.vmmemctl.average']['mean'] / 1024
+    #Memory Swapped
+    memorySwapped = metrics['mem.swapped.average']['mean'] / 1024
+    #Datastore Average IO - summed over every datastore the VM uses
+    DatastoreIoRead = metrics['datastore.numberReadAveraged.average']['mean']
+    DatastoreIoWrite = metrics['datastore.numberWriteAveraged.average']['mean']
+    #Datastore Average Latency - of the slowest datastore the VM uses
+    DatastoreLatRead = metrics['datastore.totalReadLatency.average']['mean']
+    DatastoreLatWrite = metrics['datastore.totalWriteLatency.average']['mean']
 
+    #Network usage (Tx/Rx)
+    networkTx = metrics['net.transmitted.average']['mean'] * 8 / 1024
+    networkRx = metrics['net.received.average']['mean'] * 8 / 1024
+
+    print('<p>vCPU and Memory Information</p>', file=out)
+    print('<table>', file=out)
+    html_table(out, '[VM] Limits', 'CPU: {}, Memory: {}'.format(vmcpulimit, vmmemlimit))
+    html_table(out, '[VM] Reservations', 'CPU: {}, Memory: {}'.format(vmcpures, vmmemres))
+    html_table(out, '[VM] Number of vCPUs', vmSnapshot.numCpu)
+    html_table(out, '[VM] CPU Ready', Figure(interval, 'Average {:.1f} %, Maximum {:.1f} %, 95th percentile {:.1f} %',
+                                             (cpuReady['mean'] * readyScale), (cpuReady['max'] * readyScale),
+                                             (cpuReady['p95'] * readyScale)))
+    html_table(out, '[VM] CPU (%)', Figure(interval, '{:.0f} %', cpuUsage))
+    html_table(out, '[VM] Memory', '{} MB ({:.1f} GB)'.format(vmSnapshot.memorySizeMB,
+                                                         (float(vmSnapshot.memorySizeMB) / 1024)))
+    html_table(out, '[VM] Memory Shared', Figure(interval, '{:.0f} %, {:.0f} MB',
+                                                 ((memoryShared / vmSnapshot.memorySizeMB) * 100), memoryShared))
+    html_table(out, '[VM] Memory Balloon', Figure(interval, '{:.0f} %, {:.0f} MB',
+                                                  ((memoryBalloon / vmSnapshot.memorySizeMB) * 100), memoryBalloon))
+    html_table(out, '[VM] Memory Swapped', Figure(interval, '{:.0f} %, {:.0f} MB',
+                                                  ((memorySwapped / vmSnapshot.memorySizeMB) * 100), memorySwapped))
+    html_table(out, '[VM] Memory Active', Figure(interval, '{:.0f} %, {:.0f} MB',
+                                                 ((memoryActive / vmSnapshot.memorySizeMB) * 100), memoryActive))
+    print('</table>', file=out)
+    print('<p>Datastore and Network Information</p>', file=out)
+    print('<table>', file=out)
+    html_table(out, '[VM] Datastore Average IO', Figure(interval, 'Read: {:.0f} IOPS, Write: {:.0f} IOPS',
+                                                        DatastoreIoRead, DatastoreIoWrite))
+    html_table(out, '[VM] Datastore Average Latency', Figure(interval, 'Read: {:.0f} ms, Write: {:.0f} ms',
+                                                             DatastoreLatRead, DatastoreLatWrite))
+    html_table(out, '[VM] Overall Network Usage', Figure(interval, 'Transmitted {:.3f} Mbps, Received {:.3f} Mbps',
+                                                         networkTx, networkRx))
+    print('</table>', file=out)
+    print('<p>Parent Host Information</p>', file=out)
+    print('<table>', file=out)
+    html_table(out, '[Host] Name', hostSnapshot.name)
+    html_table(out, '[Host] CPU Detail', 'Processor Sockets: {}, Cores per Socket {}'.format(
+        hostSnapshot.numCpuPkgs,
+        (hostSnapshot.numCpuCores / hostSnapshot.numCpuPkgs)))
+    html_table(out, '[Host] CPU Type', hostSnapshot.cpuModel)
+    html_table(out, '[Host] CPU Usage', 'Used: {} Mhz, Total: {} Mhz'.format(
+        hostSnapshot.cpuUsage,
+        (hostSnapshot.cpuMhz * hostSnapshot.numCpuCores)))
+    html_table(out, '[Host] Memory Usage ', 'Used: {:.0f} GB, Total: {:.0f} GB\n'.format(
+        (float(hostSnapshot.memoryUsage) / 1024),
+        (float(hostSnapshot.memorySize) / 1024 / 1024 / 1024)))
+
+    print('</table>', file=out)
+    yield out.getvalue()
+
+
+class VcenterSession(object):
+    """
+    Holds the logged in ServiceInstance and perf counter map for the vCenter in viconfig so they can be
+    shared by every request the server handles.
+    """
+
+    def __init__(self, args, password):
+        self.args = args
+        self.password = password
+        self.lock = threading.Lock()
+        self.si = None
+        self.content = None
+        self.perf_dict = None
+        self.store = None
+        self.clockOffset = timedelta(0)
+        self.vmIndex = None
+        self.indexLock = threading.Lock()
+
+    def Get(self):
+        with self.lock:
+            if self.si is None:
+                self.Connect()
+            return self.si, self.content, self.perf_dict
+
+    def Reconnect(self, si):
+        # Log in again unless another request already replaced the expired session
+        with self.lock:
+            if self.si is si:
+                self.Connect()
+
+    def Connect(self):
+        context = ssl._create_unverified_context()
+        si = SmartConnect(host=self.args['host'],
+                          user=self.args['user'],
+                          pwd=self.password,
+                          port=int(self.args['port']),
+                          sslContext=context)
+        si._stub.poolSize = max(si._stub.poolSize, CONNECTION_POOL_SIZE)
+        if self.si is None:
+            atexit.register(self.Disconnect)
+        self.si = si
+        self.content = si.RetrieveContent()
+        # The index belongs to the old session's PropertyCollector, so it is rebuilt on first use
+        with self.indexLock:
+            self.vmIndex = None
+        # Remember how far the vCenter clock is from ours so requests don't need a CurrentTime call
+        vchtime = si.CurrentTime()
+        if vchtime.tzinfo is None:
+            vchtime = vchtime.replace(tzinfo=timezone.utc)
+        self.clockOffset = vchtime - datetime.now(timezone.utc)
+        if self.perf_dict is None:
+            # Get the performance counters, from the local cache when it matches this vCenter
+            self.perf_dict = GetPerfDict(self.content, [counter_name for counter_name, instance in VM_COUNTERS],
+                                         self.args['host'], PERF_CACHE_DIR)
+        if self.store is None and self.args.get('store'):
+            self.store = SampleStore(self.args['store'], self.content.about.instanceUuid or self.args['host'])
+
+    def FindVms(self, vmnames):
+        # Bring the index up to date with whatever changed in the inventory since the last request
+        with self.indexLock:
+            if self.vmIndex is None:
+                self.vmIndex = VmIndex(self.content)
+            else:
+                self.vmIndex.Update()
+            return self.vmIndex.Find(vmnames)
+
+    def CurrentTime(self):
+        return datetime.now(timezone.utc) + self.clockOffset
+
+    def Disconnect(self):
+        if self.si is not None:
+            Disconnect(self.si)
+
+
+def PrintReport(session, vmnames, interval):
+    # Generator of the report's HTML, each VM's sections sent as soon as they are rendered
+    si, content, perf_dict = session.Get()
+    # Get vCenter date and time for use as baseline when querying for counters
+    vchtime = session.CurrentTime()
+
+    #Find VM supplied as arg and use Managed Object Reference (moref) for the PrintVmInfo
+    vms = []
+    out = StringIO()
+    for vm in session.FindVms(vmnames):
+        if vm.powerState == "poweredOn":
+            vms.append(vm.moref)
+        else:
+            print('ERROR: Problem connecting to Virtual Machine.  {} is likely powered off or suspended'.format(
+                vm.name), file=out)
+    if out.getvalue():
+        yield out.getvalue()
+
+    #Say up front which counters the statistics level of a long interval doesn't keep
+    uncollected = UncollectedCounters(content, perf_dict, [counter_name for counter_name, instance in VM_COUNTERS],
+                                      interval) if vms else []
+    if uncollected:
+        yield '<p>NOTE: The statistics level{} doesn\'t keep {}, so they are reported as not collected</p>\n'.format(
+            SampleNote(interval).replace(' of ', ' for ', 1), ', '.join(uncollected))
+
+    #Get every property the report needs for the VMs and their hosts up front
+    properties = PrefetchProperties(content, vms, VM_PROPERTIES, HOST_PROPERTIES)
+
+    for vm in vms:
+        for chunk in PrintVmInfo(vm, content, vchtime, interval, perf_dict, properties, session.store):
+            yield chunk
+
+
+class ReportCache(object):
+    """
+    Rendered reports shared by every request the server handles.  vCenter only writes a new sample every sampling
+    period (20s for realtime), so a report is reused for an identical request in the same period of the vCenter
+    clock, and identical requests that arrive while it is being built wait for that build instead of starting
+    their own.  The request that builds a report is sent each chunk as it is rendered.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.lock = threading.Lock()
+        self.reports = OrderedDict()
+        self.pending = {}
+
+    def Get(self, key, window, build):
+        # Generator of the report's chunks: a cached or shared report comes in one piece, a new one from build()
+        # as it is rendered
+        with self.lock:
+            cached = self.reports.get(key)
+            if cached is not None and cached[0] == window:
+                self.reports.move_to_end(key)
+            else:
+                cached = None
+                pending = self.pending.get((key, window))
+                building = pending is None
+                if building:
+                    pending = self.pending[(key, window)] = Future()
+        if cached is not None:
+            yield cached[1]
+            return
+        if not building:
+            yield pending.result()
+            return
+
+        chunks = []
+        streaming = True
+        try:
+            for chunk in build():
+                chunks.append(chunk)
+                if streaming:
+                    try:
+                        yield chunk
+                    except GeneratorExit:
+                        # The browser went away, but the requests waiting on this build still need all of it
+                        streaming = False
+        except Exception as e:
+            with self.lock:
+                del self.pending[(key, window)]
+            pending.set_exception(e)
+            if streaming:
+                raise
+            return
+        report = b''.join(chunks)
+        with self.lock:
+            del self.pending[(key, window)]
+            self.reports[key] = (window, report)
+            self.reports.move_to_end(key)
+            # Least recently used reports go first
+            while len(self.reports) > self.size:
+                self.reports.popitem(last=False)
+        pending.set_result(report)
+
+
+def BuildReport(session, vmnames, interval):
+    yield REPORT_STYLE.encode('utf-8')
+    sent = False
+    try:
+        for chunk in PrintReport(session, vmnames, interval):
+            sent = True
+            yield chunk.encode('utf-8')
+    except vim.fault.NotAuthenticated:
+        # The session timed out on the vCenter side, log in again and rerun the report once, as long as none of it
+        # was sent yet
+        if sent:
+            raise
+        session.Reconnect(session.si)
+        for chunk in PrintReport(session, vmnames, interval):
+            yield chunk.encode('utf-8')
+
+
+def GetSession():
+    # One session per process: for CGI that is one per request, for --serve it lives as long as the server
+    global SESSION
+    with SESSION_LOCK:
+        if SESSION is None:
+            args = viconfig.GetArgs()
+            vmstats.PAGE_SIZE = args.get('page_size') or 0
+            if args['password']:
+                password = args['password']
+            else:
+                password = getpass.getpass(prompt="Enter password for host {} and user {}: ".format(args['host'],
+                                                                                                   args['user']))
+            SESSION = VcenterSession(args, password)
+        return SESSION
+
+
+SESSION = None
+SESSION_LOCK = threading.Lock()
+REPORT_CACHE = ReportCache(REPORT_CACHE_SIZE)
+
+
+def application(environ, start_response):
+    query = parse_qs(environ.get('QUERY_STRING', ''))
+    if 'vmname' not in query:
+        with open(LAUNCH_PAGE, 'rb') as launch_page:
+            body = launch_page.read()
+        start_response('200 OK', [('Content-Type', 'text/html;charset=utf-8'), ('Content-Length', str(len(body)))])
+        return [body]
+
+    # The report is streamed, so its length isn't known up front and errors come at the end of what was sent
+    start_response('200 OK', [('Content-Type', 'text/html;charset=utf-8')])
+    return StreamReport(query['vmname'][0], query)
+
+
+def StreamReport(vmnames, query):
+    report = None
+    try:
+        session = GetSession()
+        session.Get()
+        interval = int(query.get('vminterval', ['15'])[0])
+        window = ToEpoch(session.CurrentTime()) // SamplePeriod(interval)
+        key = (session.args['host'], ','.join(SplitVmNames(vmnames)), interval)
+        report = REPORT_CACHE.Get(key, window, partial(BuildReport, session, vmnames, interval))
+        for chunk in report:
+            yield chunk
     except vmodl.MethodFault as e:
-        print('Caught vmodl fault : ' + e.msg)
-        return -1
+        yield ('Caught vmodl fault : ' + e.msg + '\n').encode('utf-8')
     except Exception as e:
-        print('Caught exception : ' + str(e))
+        yield ('Caught exception : ' + str(e) + '\n').encode('utf-8')
+    finally:
+        # Lets a report being built finish for the requests waiting on it if the browser went away
+        if report is not None:
+            report.close()
+
+
+def GetArgs():
+    """
+    Supports the command-line arguments listed below.
+    """
+    parser = argparse.ArgumentParser(description='Serve the VM statistics report over HTTP')
+    parser.add_argument('--serve', required=False, action='store_true',
+                        help='Run as a long running WSGI server instead of a CGI script')
+    parser.add_argument('-b', '--bind', default='', action='store', help='Address to listen on')
+    parser.add_argument('-l', '--listen-port', type=int, default=8080, action='store', help='Port to listen on')
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    if 'GATEWAY_INTERFACE' in os.environ:
+        CGIHandler().run(application)
+        return 0
+
+    args = GetArgs()
+    if not args.serve:
+        print('Run with --serve to start the WSGI server, or run from a web server as a CGI script')
         return -1
+    # Log in before accepting requests so a password prompt happens here and the first request is fast
+    GetSession().Get()
+    httpd = make_server(args.bind, args.listen_port, application, server_class=ThreadingWSGIServer)
+    print('Serving on port {}'.format(args.listen_port))
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
 
     return 0
 
@@ -8,228 +8,837 @@ A list of virtual machines can be provided as a comma separated list.
 
 from __future__ import print_function
 from pyVim.connect import SmartConnect, Disconnect
-from pyVmomi import vmodl, vim
+from pyVmomi import SoapAdapter, vmodl, vim
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+from wsgiref.simple_server import make_server
+from xml.parsers.expat import ExpatError
 from datetime import timedelta, datetime
 
 import argparse
+import asyncio
 import atexit
+import csv
+import fnmatch
 import getpass
+import heapq
+import http.client
+import json
+import math
+import os
+import re
+import sys
+import threading
+import time
+import vmstats
 
 import ssl
 
+from vmstats import (BuildQuery, FetchStoredStats, Figure, GetPerfDict, GetProperties, HOST_PROPERTIES, MatchNames,
+                     PERF_CACHE_DIR, PrefetchProperties, QueryWindow, ReduceStats, RetrieveProperties, STATS_INTERVALS,
+                     SampleNote, SamplePeriod, SampleStore, SplitPerfResults, SplitVmNames, StatCheck,
+                     ThreadingWSGIServer, UncollectedCounters, VM_COUNTERS, VM_PROPERTIES, VmIndex, VmMetricIds,
+                     VmSnapshot)
+
+# Counters queried for each host in a --esxi or --cluster report
+HOST_COUNTERS = [('cpu.usage.average', ''),
+                 ('mem.usage.average', ''),
+                 ('mem.vmmemctl.average', ''),
+                 ('mem.swapused.average', ''),
+                 ('net.usage.average', '')]
+
+# --top fetches the full perf series for this many times N of the best screened VMs
+TOP_SHORTLIST = 4
+
+# VMs listed by CPU ready in each host and cluster report
+ROLLUP_TOP = 5
+
+# -m entries that are looked up through the SearchIndex by BIOS or instance UUID instead of by name
+UUID_PATTERN = re.compile(r'^[0-9a-f]{8}-?[0-9a-f]{4}-?[0-9a-f]{4}-?[0-9a-f]{4}-?[0-9a-f]{12}$', re.IGNORECASE)
+
+# Worker threads allowed to share one vCenter session before --workers logs in another session
+SESSION_CONCURRENCY = 4
+
+# VMs listed in the --profile summary, and the most calls --profile-trace keeps (so the exporter can't grow forever)
+PROFILE_TOP_VMS = 10
+PROFILE_MAX_SPANS = 100000
+
+# Gauges exposed by --format prom as (name, help, record key, scale to base units)
+PROM_METRICS = [
+    ('vmstats_cpu_ready_ratio', 'Share of time a vCPU was ready to run but not scheduled, averaged over the interval',
+     'cpu_ready_avg_pct', 0.01),
+    ('vmstats_cpu_ready_max_ratio', 'Highest CPU ready share of any sample in the interval', 'cpu_ready_max_pct',
+     0.01),
+    ('vmstats_cpu_ready_p95_ratio', '95th percentile CPU ready share of the samples in the interval',
+     'cpu_ready_p95_pct', 0.01),
+    ('vmstats_cpu_usage_ratio', 'CPU usage averaged over the interval', 'cpu_usage_pct', 0.01),
+    ('vmstats_memory_size_bytes', 'Configured memory', 'memory_mb', 1024 * 1024),
+    ('vmstats_memory_shared_bytes', 'Shared memory', 'mem_shared_mb', 1024 * 1024),
+    ('vmstats_memory_balloon_bytes', 'Memory reclaimed by the balloon driver', 'mem_balloon_mb', 1024 * 1024),
+    ('vmstats_memory_swapped_bytes', 'Memory swapped out by the host', 'mem_swapped_mb', 1024 * 1024),
+    ('vmstats_memory_active_bytes', 'Active memory', 'mem_active_mb', 1024 * 1024),
+    ('vmstats_datastore_read_iops', 'Read operations per second, summed over every datastore',
+     'datastore_read_iops', 1),
+    ('vmstats_datastore_write_iops', 'Write operations per second, summed over every datastore',
+     'datastore_write_iops', 1),
+    ('vmstats_datastore_read_latency_seconds', 'Read latency of the slowest datastore', 'datastore_read_latency_ms',
+     0.001),
+    ('vmstats_datastore_write_latency_seconds', 'Write latency of the slowest datastore',
+     'datastore_write_latency_ms', 0.001),
+    ('vmstats_network_transmit_bits_per_second', 'Network transmit rate', 'net_tx_mbps', 1024 * 1024),
+    ('vmstats_network_receive_bits_per_second', 'Network receive rate', 'net_rx_mbps', 1024 * 1024),
+]
+
+
 def GetArgs():
     """
     Supports the command-line arguments listed below.
     """
     parser = argparse.ArgumentParser(description='Process args for retrieving all the Virtual Machines')
-    parser.add_argument('-s', '--host', required=True, action='store', help='Remote host to connect to')
+    parser.add_argument('-s', '--host', required=False, action='store', help='Remote host to connect to')
     parser.add_argument('-o', '--port', type=int, default=443, action='store', help='Port to connect on')
-    parser.add_argument('-u', '--user', required=True, action='store', help='User name to use when connecting to host')
+    parser.add_argument('-u', '--user', required=False, action='store',
+                        help='User name to use when connecting to host')
     parser.add_argument('-p', '--password', required=False, action='store',
                         help='Password to use when connecting to host')
-    parser.add_argument('-m', '--vm', required=True, action='store', help='On eor more Virtual Machines to report on')
+    parser.add_argument('-m', '--vm', required=False, action='store',
+                        help='One or more Virtual Machines to report on, as a comma separated list of names, globs or '
+                             'UUIDs')
+    parser.add_argument('--esxi', required=False, action='store', metavar='HOSTS',
+                        help='Report on ESXi hosts and the VMs on them instead of VMs, as a comma separated list of '
+                             'names or globs')
+    parser.add_argument('--cluster', required=False, action='store', metavar='CLUSTERS',
+                        help='Report on clusters, their hosts and the VMs on them instead of VMs, as a comma separated '
+                             'list of names or globs')
+    parser.add_argument('--top', type=int, default=0, action='store', metavar='N',
+                        help='Report the N VMs in the whole inventory with the worst --by metric instead of -m VMs')
+    parser.add_argument('--by', default='cpu.ready', choices=['cpu.ready', 'datastore.latency', 'mem.swapped'],
+                        help='What --top ranks the VMs on (default cpu.ready)')
     parser.add_argument('-c', '--cert_check_skip', required=False, action='store_true', help='skip ssl certificate check')
     parser.add_argument('-i', '--interval', type=int, default=15, action='store',
-                        help='Interval to average the vSphere stats over')
+                        help='Interval in minutes to average the vSphere stats over.  Over 60 minutes the samples come '
+                             'from the historical rollups (5 minute, 30 minute, 2 hour or 1 day)')
+    parser.add_argument('-k', '--chunk-size', type=int, default=0, action='store',
+                        help='Number of VMs to query per QueryPerf call (default: as many as '
+                             'config.vpxd.stats.maxQueryMetrics allows)')
+    parser.add_argument('-w', '--workers', type=int, default=1, action='store',
+                        help='Number of chunks of VMs to collect in parallel')
+    parser.add_argument('-e', '--endpoints', required=False, action='store_true',
+                        help='Report on every vCenter listed by GetEndpoints() in viconfig.py instead of --host')
+    parser.add_argument('--watch', type=int, nargs='?', const=20, default=0, action='store', metavar='SECONDS',
+                        help='Keep reporting every SECONDS (default 20), fetching only the new samples each time')
+    parser.add_argument('--store', required=False, action='store', metavar='DIR',
+                        help='Keep the collected samples in DIR and only query vCenter for samples not already there')
+    parser.add_argument('-f', '--format', default='text', choices=['text', 'json', 'jsonl', 'csv', 'prom'],
+                        help='Output format.  Every format but text is written one VM at a time as each is collected, '
+                             'with errors on stderr')
+    parser.add_argument('--exporter', type=int, default=0, action='store', metavar='PORT',
+                        help='Serve the metrics for Prometheus on PORT at /metrics, collected in the background')
+    parser.add_argument('--refresh', type=int, default=60, action='store', metavar='SECONDS',
+                        help='How often the --exporter collector refreshes the metrics (default 60)')
+    parser.add_argument('-b', '--bind', default='', action='store', help='Address the --exporter listens on')
+    parser.add_argument('--page-size', type=int, default=0, action='store', metavar='N',
+                        help='Objects per page when retrieving properties (default: vCenter decides).  Bigger pages '
+                             'mean fewer round trips, which matters most over a WAN link')
+    parser.add_argument('--no-counter-cache', required=False, action='store_true',
+                        help='Always download the perf counter catalog instead of using the local cache')
+    parser.add_argument('--session-cache', required=False, action='store_true',
+                        help='Stay logged in between runs, reattaching to the previous run\'s session (kept readable '
+                             'by you only in the cache directory) instead of logging in again until vCenter expires it')
+    parser.add_argument('--profile', required=False, action='store_true',
+                        help='Time every vSphere API call and print a summary by stage, method and VM to stderr')
+    parser.add_argument('--profile-trace', required=False, action='store', metavar='FILE',
+                        help='With --profile, also write every call as a trace span to FILE (Chrome trace format)')
     args = parser.parse_args()
+    if not args.endpoints and not (args.host and args.user):
+        parser.error('--host and --user are required unless --endpoints is given')
+    if not (args.vm or args.esxi or args.cluster or args.top):
+        parser.error('one of --vm, --esxi, --cluster or --top is required')
+    if args.top and (args.vm or args.esxi or args.cluster or args.endpoints or args.watch or args.exporter):
+        parser.error('--top can not be combined with --vm, --esxi, --cluster, --endpoints, --watch or --exporter')
+    if (args.esxi or args.cluster) and (args.vm or args.endpoints or args.watch or args.exporter):
+        parser.error('--esxi and --cluster reports can not be combined with --vm, --endpoints, --watch or --exporter')
+    if (args.esxi or args.cluster) and args.format in ('csv', 'prom'):
+        parser.error('--esxi and --cluster reports can only be written as text, json or jsonl')
+    if args.watch and args.format == 'prom':
+        parser.error('--watch can not be written as prom, use --exporter to serve the metrics instead')
+    if args.endpoints and args.watch:
+        parser.error('--watch can only be used with a single vCenter')
+    if args.watch and SamplePeriod(args.interval) != 20:
+        parser.error('--watch needs realtime statistics, so an --interval of at most {} minutes'.format(
+            STATS_INTERVALS[0][1]))
+    if args.exporter and (args.endpoints or args.watch):
+        parser.error('--exporter can only be used with a single vCenter and without --watch')
+    if args.profile_trace:
+        args.profile = True
     return args
 
 
-def BuildQuery(content, vchtime, counterId, instance, vm, interval):
+def BuildBulkQuery(content, vchtime, metricIds, vms, interval, chunkSize):
+    # Query many VMs per QueryPerf call, yielding (vm, stats) for each VM as soon as its chunk comes back.
+    # stats is None for a VM that returned no performance data
     perfManager = content.perfManager
-    metricId = vim.PerformanceManager.MetricId(counterId=counterId, instance=instance)
-    startTime = vchtime - timedelta(minutes=(interval + 1))
-    endTime = vchtime - timedelta(minutes=1)
-    query = vim.PerformanceManager.QuerySpec(intervalId=20, entity=vm, metricId=[metricId], startTime=startTime,
-                                             endTime=endTime)
-    perfResults = perfManager.QueryPerf(querySpec=[query])
-    if perfResults:
-        return perfResults
-    else:
-        print('ERROR: Performance results empty.  TIP: Check time drift on source and vCenter server')
-        print('Troubleshooting info:')
-        print('vCenter/host date and time: {}'.format(vchtime))
-        print('Start perf counter time   :  {}'.format(startTime))
-        print('End perf counter time     :  {}'.format(endTime))
-        print(query)
-        exit()
+    startTime, endTime, samplingPeriod, maxSample = QueryWindow(vchtime, interval)
+    for chunkStart in range(0, len(vms), chunkSize):
+        chunk = vms[chunkStart:chunkStart + chunkSize]
+        querySpecs = [vim.PerformanceManager.QuerySpec(intervalId=samplingPeriod, entity=vm, metricId=metricIds,
+                                                       startTime=startTime, endTime=endTime, maxSample=maxSample)
+                      for vm in chunk]
+        perfResults = perfManager.QueryPerf(querySpec=querySpecs)
+        chunkStats = {}
+        for entityMetric in perfResults:
+            chunkStats[entityMetric.entity] = SplitPerfResults(entityMetric)
+        for vm in chunk:
+            yield vm, chunkStats.get(vm)
 
 
+class SessionPool(object):
+    """
+    Hands each worker thread the content of one of a fixed set of logged in sessions, spreading the workers
+    round robin so no session has more than SESSION_CONCURRENCY of them.
+    """
 
-def PrintVmInfo(vm, content, vchtime, interval, perf_dict, ):
-    statInt = interval * 3  # There are 3 20s samples in each minute
-    summary = vm.summary
-    disk_list = []
-    network_list = []
+    def __init__(self, sessions):
+        self.sessions = sessions
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.nextSession = 0
 
-    # Convert limit and reservation values from -1 to None
-    if vm.resourceConfig.cpuAllocation.limit == -1:
-        vmcpulimit = "None"
-    else:
-        vmcpulimit = "{} Mhz".format(vm.resourceConfig.cpuAllocation.limit)
-    if vm.resourceConfig.memoryAllocation.limit == -1:
-        vmmemlimit = "None"
-    else:
-        vmmemlimit = "{} MB".format(vm.resourceConfig.memoryAllocation.limit)
+    def Content(self):
+        if not hasattr(self.local, 'content'):
+            with self.lock:
+                self.local.content = self.sessions[self.nextSession % len(self.sessions)]
+                self.nextSession += 1
+        return self.local.content
 
-    if vm.resourceConfig.cpuAllocation.reservation == 0:
-        vmcpures = "None"
-    else:
-        vmcpures = "{} Mhz".format(vm.resourceConfig.cpuAllocation.reservation)
-    if vm.resourceConfig.memoryAllocation.reservation == 0:
-        vmmemres = "None"
-    else:
-        vmmemres = "{} MB".format(vm.resourceConfig.memoryAllocation.reservation)
-
-    vm_hardware = vm.config.hardware
-    for each_vm_hardware in vm_hardware.device:
-        if (each_vm_hardware.key >= 2000) and (each_vm_hardware.key < 3000):
-            disk_list.append('{} | {:.1f}GB | Thin: {} | {}'.format(each_vm_hardware.deviceInfo.label,
-                                                         each_vm_hardware.capacityInKB/1024/1024,
-                                                         each_vm_hardware.backing.thinProvisioned,
-                                                         each_vm_hardware.backing.fileName))
-        elif (each_vm_hardware.key >= 4000) and (each_vm_hardware.key < 5000):
-            network_list.append('{} | {} | {}'.format(each_vm_hardware.deviceInfo.label,
-                                                         each_vm_hardware.deviceInfo.summary,
-                                                         each_vm_hardware.macAddress))
-
-    #CPU Ready Average
-    statCpuReady = BuildQuery(content, vchtime, (StatCheck(perf_dict, 'cpu.ready.summation')), "", vm, interval)
-    cpuReady = (float(sum(statCpuReady[0].value[0].value)) / statInt)
-    #CPU Usage Average % - NOTE: values are type LONG so needs divided by 100 for percentage
-    statCpuUsage = BuildQuery(content, vchtime, (StatCheck(perf_dict, 'cpu.usage.average')), "", vm, interval)
-    cpuUsage = ((float(sum(statCpuUsage[0].value[0].value)) / statInt) / 100)
-    #Memory Active Average MB
-    statMemoryActive = BuildQuery(content, vchtime, (StatCheck(perf_dict, 'mem.active.average')), "", vm, interval)
-    memoryActive = (float(sum(statMemoryActive[0].value[0].value) / 1024) / statInt)
-    #Memory Shared
-    statMemoryShared = BuildQuery(content, vchtime, (StatCheck(perf_dict, 'mem.shared.average')), "", vm, interval)
-    memoryShared = (float(sum(statMemoryShared[0].value[0].value) / 1024) / statInt)
-    #Memory Balloon
-    statMemoryBalloon = BuildQuery(content, vchtime, (StatCheck(perf_dict, 'mem.vmmemctl.average')), "", vm, interval)
-    memoryBalloon = (float(sum(statMemoryBalloon[0].value[0].value) / 1024) / statInt)
-    #Memory Swapped
-    statMemorySwapped = BuildQuery(content, vchtime, (StatCheck(perf_dict, 'mem.swapped.average')), "", vm, interval)
-    memorySwapped = (float(sum(statMemorySwapped[0].value[0].value) / 1024) / statInt)
-    #Datastore Average IO
-    statDatastoreIoRead = BuildQuery(content, vchtime, (StatCheck(perf_dict, 'datastore.numberReadAveraged.average')),
-                                     "*", vm, interval)
-    DatastoreIoRead = (float(sum(statDatastoreIoRead[0].value[0].value)) / statInt)
-    statDatastoreIoWrite = BuildQuery(content, vchtime, (StatCheck(perf_dict, 'datastore.numberWriteAveraged.average')),
-                                      "*", vm, interval)
-    DatastoreIoWrite = (float(sum(statDatastoreIoWrite[0].value[0].value)) / statInt)
-    #Datastore Average Latency
-    statDatastoreLatRead = BuildQuery(content, vchtime, (StatCheck(perf_dict, 'datastore.totalReadLatency.average')),
-                                      "*", vm, interval)
-    DatastoreLatRead = (float(sum(statDatastoreLatRead[0].value[0].value)) / statInt)
-    statDatastoreLatWrite = BuildQuery(content, vchtime, (StatCheck(perf_dict, 'datastore.totalWriteLatency.average')),
-                                       "*", vm, interval)
-    DatastoreLatWrite = (float(sum(statDatastoreLatWrite[0].value[0].value)) / statInt)
-
-    #Network usage (Tx/Rx)
-    statNetworkTx = BuildQuery(content, vchtime, (StatCheck(perf_dict, 'net.transmitted.average')), "", vm, interval)
-    networkTx = (float(sum(statNetworkTx[0].value[0].value) * 8 / 1024) / statInt)
-    statNetworkRx = BuildQuery(content, vchtime, (StatCheck(perf_dict, 'net.received.average')), "", vm, interval)
-    networkRx = (float(sum(statNetworkRx[0].value[0].value) * 8 / 1024) / statInt)
-
-    print('\nNOTE: Any VM statistics are averages of the last {} minutes\n'.format(statInt / 3))
-    print('Server Name                    :', summary.config.name)
-    print('Description                    :', summary.config.annotation)
-    print('Guest                          :', summary.config.guestFullName)
-    if vm.rootSnapshot:
-        print('Snapshot Status                : Snapshots present')
-    else:
-        print('Snapshot Status                : No Snapshots')
-    print('VM .vmx Path                   :', summary.config.vmPathName)
+
+class Profiler(object):
+    """
+    Opt-in --profile instrumentation of the pyVmomi SOAP stub.  Every call is timed, sized and charged to the report
+    stage and VMs the calling thread is working on, which Stage sets (per thread, so collection workers count too).
+    """
+
+    def __init__(self):
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.enabled = False
+        self.started = time.time()
+        self.methods = OrderedDict()
+        self.stages = OrderedDict()
+        self.vms = {}
+        self.names = {}
+        self.spans = None
+
+    def Install(self, trace=False):
+        # Wrapped at class level, so every session logged in from here on is profiled, SmartConnect included
+        profiler = self
+        serializeRequest = SoapAdapter.SoapStubAdapter.SerializeRequest
+        read = http.client.HTTPResponse.read
+
+        def Profiled(invokeMethod):
+            def ProfiledInvokeMethod(stub, mo, info, args, outerStub=None):
+                profiler.local.sent = profiler.local.received = 0
+                started = time.time()
+                try:
+                    return invokeMethod(stub, mo, info, args, outerStub)
+                finally:
+                    # Property reads all go through Fetch, so name the property to tell them apart
+                    method = 'Fetch({})'.format(args[0]) if info.wsdlName == 'Fetch' else info.wsdlName
+                    profiler.Record(method, started, time.time() - started, profiler.local.sent,
+                                    profiler.local.received)
+            return ProfiledInvokeMethod
+
+        def ProfiledSerializeRequest(stub, mo, info, args):
+            request = serializeRequest(stub, mo, info, args)
+            profiler.local.sent = getattr(profiler.local, 'sent', 0) + len(request)
+            return request
+
+        def ProfiledRead(response, *args):
+            # Counted before decompression, so this is what actually came over the wire
+            data = read(response, *args)
+            profiler.local.received = getattr(profiler.local, 'received', 0) + len(data)
+            return data
+
+        # Stubs that answer calls themselves, like the benchmark stand-in, override InvokeMethod, so theirs is
+        # wrapped as well
+        stubClasses = [SoapAdapter.SoapStubAdapter]
+        for stubClass in stubClasses:
+            stubClasses.extend(stubClass.__subclasses__())
+        for stubClass in stubClasses:
+            if 'InvokeMethod' in vars(stubClass):
+                stubClass.InvokeMethod = Profiled(vars(stubClass)['InvokeMethod'])
+        SoapAdapter.SoapStubAdapter.SerializeRequest = ProfiledSerializeRequest
+        http.client.HTTPResponse.read = ProfiledRead
+        self.enabled = True
+        self.started = time.time()
+        if trace:
+            self.spans = []
+
+    @contextmanager
+    def Stage(self, stage, vms=(), timed=True):
+        # Untimed stages only charge their calls to the stage and VMs.  Worker threads use them, as the wall time of
+        # chunks running side by side would add up to more than actually went by, and the caller times the stage
+        # once around its executor instead
+        previous = getattr(self.local, 'stage', None), getattr(self.local, 'vms', ())
+        self.local.stage = stage
+        self.local.vms = vms
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.local.stage, self.local.vms = previous
+            if self.enabled and timed:
+                with self.lock:
+                    self.StageTotals(stage)[4] += time.time() - started
+                    if self.spans is not None and len(self.spans) < PROFILE_MAX_SPANS and not vms:
+                        self.spans.append(self.Span(stage, 'stage', started, time.time() - started, {}))
+
+    def Names(self, properties):
+        # Lets the summary show VM names instead of morefs for the VMs the report prefetched
+        for moref, snapshot in properties.items():
+            if isinstance(snapshot, VmSnapshot) and snapshot.name:
+                self.names[moref._moId] = snapshot.name
+
+    def StageTotals(self, stage):
+        # calls, SOAP seconds, bytes sent, bytes received, wall seconds
+        return self.stages.setdefault(stage, [0, 0.0, 0, 0, 0.0])
+
+    def Span(self, name, category, started, seconds, spanArgs):
+        # Chrome trace event format, loads in chrome://tracing or https://ui.perfetto.dev
+        return {'name': name, 'cat': category, 'ph': 'X', 'pid': os.getpid(), 'tid': threading.get_ident(),
+                'ts': int((started - self.started) * 1000000), 'dur': int(seconds * 1000000), 'args': spanArgs}
+
+    def Record(self, method, started, seconds, sent, received):
+        stage = getattr(self.local, 'stage', None) or 'other'
+        vms = getattr(self.local, 'vms', ())
+        with self.lock:
+            totals = self.methods.setdefault(method, [0, 0.0, 0.0, 0, 0])
+            totals[0] += 1
+            totals[1] += seconds
+            totals[2] = max(totals[2], seconds)
+            totals[3] += sent
+            totals[4] += received
+            totals = self.StageTotals(stage)
+            totals[0] += 1
+            totals[1] += seconds
+            totals[2] += sent
+            totals[3] += received
+            # A call made for a chunk of VMs is shared out between them evenly
+            for vm in vms:
+                totals = self.vms.setdefault(vm._moId, [0.0, 0.0, 0.0, 0.0])
+                totals[0] += 1.0 / len(vms)
+                totals[1] += seconds / len(vms)
+                totals[2] += float(sent) / len(vms)
+                totals[3] += float(received) / len(vms)
+            if self.spans is not None and len(self.spans) < PROFILE_MAX_SPANS:
+                self.spans.append(self.Span(method, stage, started, seconds, {
+                    'stage': stage, 'bytes_sent': sent, 'bytes_received': received,
+                    'vms': [self.names.get(vm._moId, vm._moId) for vm in vms[:PROFILE_TOP_VMS]]}))
+
+    def Summary(self, out):
+        with self.lock:
+            calls = sum(totals[0] for totals in self.methods.values())
+            print('\nProfile: {} SOAP calls, {:.3f}s in calls, {:.1f} KB sent, {:.1f} KB received, {:.3f}s '
+                  'total'.format(calls, sum(totals[1] for totals in self.methods.values()),
+                                 sum(totals[3] for totals in self.methods.values()) / 1024.0,
+                                 sum(totals[4] for totals in self.methods.values()) / 1024.0,
+                                 time.time() - self.started), file=out)
+            print('\n{:<24} {:>7} {:>10} {:>10} {:>12} {:>10}'.format('Stage', 'Calls', 'SOAP secs', 'KB sent',
+                                                                     'KB received', 'Wall secs'), file=out)
+            for stage, totals in self.stages.items():
+                print('{:<24} {:>7} {:>10.3f} {:>10.1f} {:>12.1f} {:>10.3f}'.format(
+                    stage, totals[0], totals[1], totals[2] / 1024.0, totals[3] / 1024.0, totals[4]), file=out)
+            print('\n{:<40} {:>7} {:>10} {:>10} {:>10} {:>12}'.format('Method', 'Calls', 'Seconds', 'Max secs',
+                                                                      'KB sent', 'KB received'), file=out)
+            for method, totals in sorted(self.methods.items(), key=lambda item: -item[1][1]):
+                print('{:<40} {:>7} {:>10.3f} {:>10.3f} {:>10.1f} {:>12.1f}'.format(
+                    method, totals[0], totals[1], totals[2], totals[3] / 1024.0, totals[4] / 1024.0), file=out)
+            if self.vms:
+                print('\n{:<40} {:>7} {:>10} {:>10} {:>12}'.format(
+                    'Slowest VMs (chunk calls shared out)', 'Calls', 'Seconds', 'KB sent', 'KB received'), file=out)
+                for vm, totals in heapq.nlargest(PROFILE_TOP_VMS, self.vms.items(), key=lambda item: item[1][1]):
+                    print('{:<40} {:>7.1f} {:>10.3f} {:>10.1f} {:>12.1f}'.format(
+                        self.names.get(vm, vm), totals[0], totals[1], totals[2] / 1024.0, totals[3] / 1024.0),
+                        file=out)
+
+    def WriteTrace(self, path):
+        with self.lock:
+            with open(path, 'w') as traceFile:
+                json.dump({'traceEvents': self.spans or [], 'displayTimeUnit': 'ms'}, traceFile)
+
+
+PROFILE = Profiler()
+
+
+def QueryChunk(query, vms, errors=None):
+    # Runs query(vms) for a chunk of VMs, which returns a dictionary keyed by moref.  If the chunk's query faults
+    # its VMs are queried one at a time, so one bad VM doesn't lose the rest of the chunk.  The fault message of
+    # each VM that still fails on its own goes in errors, and the fault is only raised when every VM fails
     try:
-        print('Virtual Disks                  :', disk_list[0])
-        if len(disk_list) > 1:
-            disk_list.pop(0)
-            for each_disk in disk_list:
-                print('                                ', each_disk)
-    except IndexError:
-        pass
-    print('Virtual NIC(s)                 :', network_list[0])
-    if len(network_list) > 1:
-        network_list.pop(0)
-        for each_vnic in network_list:
-            print('                                ', each_vnic)
-    print('[VM] Limits                    : CPU: {}, Memory: {}'.format(vmcpulimit, vmmemlimit))
-    print('[VM] Reservations              : CPU: {}, Memory: {}'.format(vmcpures, vmmemres))
-    print('[VM] Number of vCPUs           :', summary.config.numCpu)
-    print('[VM] CPU Ready                 : Average {:.1f} %, Maximum {:.1f} %'.format((cpuReady / 20000 * 100),
-                                                                                       ((float(max(
-                                                                                           statCpuReady[0].value[
-                                                                                               0].value)) / 20000 * 100))))
-    print('[VM] CPU (%)                   : {:.0f} %'.format(cpuUsage))
-    print('[VM] Memory                    : {} MB ({:.1f} GB)'.format(summary.config.memorySizeMB, (float(summary.config.memorySizeMB) / 1024)))
-    print('[VM] Memory Shared             : {:.0f} %, {:.0f} MB'.format(
-        ((memoryShared / summary.config.memorySizeMB) * 100), memoryShared))
-    print('[VM] Memory Balloon            : {:.0f} %, {:.0f} MB'.format(
-        ((memoryBalloon / summary.config.memorySizeMB) * 100), memoryBalloon))
-    print('[VM] Memory Swapped            : {:.0f} %, {:.0f} MB'.format(
-        ((memorySwapped / summary.config.memorySizeMB) * 100), memorySwapped))
-    print('[VM] Memory Active             : {:.0f} %, {:.0f} MB'.format(
-        ((memoryActive / summary.config.memorySizeMB) * 100), memoryActive))
-    print('[VM] Datastore Average IO      : Read: {:.0f} IOPS, Write: {:.0f} IOPS'.format(DatastoreIoRead,
-                                                                                          DatastoreIoWrite))
-    print('[VM] Datastore Average Latency : Read: {:.0f} ms, Write: {:.0f} ms'.format(DatastoreLatRead,
-                                                                                      DatastoreLatWrite))
-    print('[VM] Overall Network Usage     : Transmitted {:.3f} Mbps, Received {:.3f} Mbps'.format(networkTx, networkRx))
-    print('[Host] Name                    : {}'.format(summary.runtime.host.name))
+        return query(vms)
+    except vim.fault.NotAuthenticated:
+        raise
+    except vmodl.MethodFault as e:
+        if len(vms) == 1:
+            raise
+        results = {}
+        vmErrors = {}
+        for vm in vms:
+            try:
+                results.update(query([vm]))
+            except vim.fault.NotAuthenticated:
+                raise
+            except vmodl.MethodFault as vmError:
+                vmErrors[vm] = vmError.msg or str(vmError)
+        if len(vmErrors) == len(vms):
+            raise e
+        if errors is not None:
+            errors.update(vmErrors)
+        return results
+
+
+def CollectVms(sessionPool, vchtime, metricIds, vms, interval, perf_dict, store=None, errors=None):
+    # Worker for one chunk of VMs, returns the reduced metrics of each VM that had perf data keyed by moref
+    content = sessionPool.Content()
+    chunkStats = QueryChunk(lambda chunk: CollectStats(content, store, vchtime, metricIds, chunk, interval), vms,
+                            errors)
+    vmsWithStats = [vm for vm in vms if chunkStats.get(vm)]
+    return dict(zip(vmsWithStats, ReduceStats([chunkStats[vm] for vm in vmsWithStats], perf_dict)))
+
+
+def CollectStats(content, store, vchtime, metricIds, vms, interval):
+    with PROFILE.Stage('collect', vms, timed=False):
+        if store:
+            return FetchStoredStats(content, store, vchtime, metricIds, vms, interval)
+        return dict(BuildBulkQuery(content, vchtime, metricIds, vms, interval, len(vms)))
+
+
+def GetChunkSize(content, chunkSize, metricsPerVm):
+    # vCenter rejects a QueryPerf call asking for more than config.vpxd.stats.maxQueryMetrics entity/counter
+    # combinations, so cap the number of VMs per call to fit under that limit (a value <= 0 disables the limit)
+    try:
+        maxQueryMetrics = int(content.setting.QueryOptions('config.vpxd.stats.maxQueryMetrics')[0].value)
+    except (vmodl.MethodFault, IndexError, ValueError, AttributeError):
+        maxQueryMetrics = 64
+    if maxQueryMetrics > 0:
+        maxChunkSize = max(1, maxQueryMetrics // metricsPerVm)
+        if chunkSize <= 0 or chunkSize > maxChunkSize:
+            return maxChunkSize
+    elif chunkSize <= 0:
+        return 64
+    return chunkSize
+
+
+def VmRecord(vm, content, vchtime, interval, perf_dict, properties, metrics=None, vcenter=None):
+    # Everything the report shows for one VM as plain values, so each output format only has to render it
+    vmSnapshot = properties[vm]
+    hostSnapshot = properties[vmSnapshot.host]
+    disk_list = [OrderedDict([('label', disk.label), ('capacity_gb', disk.capacityKb / 1024 / 1024),
+                              ('thin', disk.thin), ('file', disk.fileName)]) for disk in vmSnapshot.disks]
+    network_list = [OrderedDict([('label', nic.label), ('network', nic.network), ('mac', nic.mac)])
+                    for nic in vmSnapshot.nics]
+
+    #Fetch every counter in one QueryPerf call and reduce the series, unless the caller already has the metrics
+    #from a bulk query
+    if metrics is None:
+        stats = SplitPerfResults(BuildQuery(content, vchtime, VmMetricIds(perf_dict), vm, interval)[0])
+        metrics = ReduceStats([stats], perf_dict)[0]
+
+    #CPU Ready - milliseconds of each sample spent ready, as a percentage of the sampling period
+    cpuReady = metrics['cpu.ready.summation']
+    samplingPeriod = SamplePeriod(interval)
+
+    # Limits and reservations that aren't set (-1 and 0) are None
+    return OrderedDict([
+        ('timestamp', vchtime.isoformat()),
+        ('interval', interval),
+        ('sample_seconds', samplingPeriod),
+        ('vcenter', vcenter),
+        ('vm', vmSnapshot.name),
+        ('moref', vm._moId),
+        ('description', vmSnapshot.annotation),
+        ('guest', vmSnapshot.guestFullName),
+        ('snapshots', vmSnapshot.hasSnapshot),
+        ('vmx_path', vmSnapshot.vmPathName),
+        ('disks', disk_list),
+        ('nics', network_list),
+        ('cpu_limit_mhz', None if vmSnapshot.cpuLimit == -1 else vmSnapshot.cpuLimit),
+        ('mem_limit_mb', None if vmSnapshot.memLimit == -1 else vmSnapshot.memLimit),
+        ('cpu_reservation_mhz', vmSnapshot.cpuReservation or None),
+        ('mem_reservation_mb', vmSnapshot.memReservation or None),
+        ('num_cpu', vmSnapshot.numCpu),
+        ('cpu_ready_avg_pct', cpuReady['mean'] / (samplingPeriod * 1000) * 100),
+        ('cpu_ready_max_pct', cpuReady['max'] / (samplingPeriod * 1000) * 100),
+        ('cpu_ready_p95_pct', cpuReady['p95'] / (samplingPeriod * 1000) * 100),
+        #CPU Usage Average % - NOTE: values are type LONG so needs divided by 100 for percentage
+        ('cpu_usage_pct', metrics['cpu.usage.average']['mean'] / 100),
+        ('memory_mb', vmSnapshot.memorySizeMB),
+        ('mem_shared_mb', metrics['mem.shared.average']['mean'] / 1024),
+        ('mem_balloon_mb', metrics['mem.vmmemctl.average']['mean'] / 1024),
+        ('mem_swapped_mb', metrics['mem.swapped.average']['mean'] / 1024),
+        ('mem_active_mb', metrics['mem.active.average']['mean'] / 1024),
+        #Datastore Average IO - summed over every datastore the VM uses
+        ('datastore_read_iops', metrics['datastore.numberReadAveraged.average']['mean']),
+        ('datastore_write_iops', metrics['datastore.numberWriteAveraged.average']['mean']),
+        #Datastore Average Latency - of the slowest datastore the VM uses
+        ('datastore_read_latency_ms', metrics['datastore.totalReadLatency.average']['mean']),
+        ('datastore_write_latency_ms', metrics['datastore.totalWriteLatency.average']['mean']),
+        #Network usage (Tx/Rx)
+        ('net_tx_mbps', metrics['net.transmitted.average']['mean'] * 8 / 1024),
+        ('net_rx_mbps', metrics['net.received.average']['mean'] * 8 / 1024),
+        ('host', hostSnapshot.name),
+        ('host_sockets', hostSnapshot.numCpuPkgs),
+        ('host_cores_per_socket', hostSnapshot.numCpuCores / hostSnapshot.numCpuPkgs),
+        ('host_cpu_model', hostSnapshot.cpuModel),
+        ('host_cpu_used_mhz', hostSnapshot.cpuUsage),
+        ('host_cpu_total_mhz', hostSnapshot.cpuMhz * hostSnapshot.numCpuCores),
+        ('host_mem_used_gb', float(hostSnapshot.memoryUsage) / 1024),
+        ('host_mem_total_gb', float(hostSnapshot.memorySize) / 1024 / 1024 / 1024),
+    ])
+
+
+def JsonValue(value):
+    # A counter with no samples reduces to NaN, which isn't valid JSON, so it is written as null
+    if isinstance(value, float) and not math.isfinite(value):
+        return None
+    if isinstance(value, dict):
+        return OrderedDict((key, JsonValue(item)) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return [JsonValue(item) for item in value]
+    return value
+
+
+def DiskText(disk):
+    return '{} | {:.1f}GB | Thin: {} | {}'.format(disk['label'], disk['capacity_gb'], disk['thin'], disk['file'])
+
+
+def NicText(nic):
+    return '{} | {} | {}'.format(nic['label'], nic['network'], nic['mac'])
+
+
+def PrintVmInfo(record, out=None):
+    # The original plain text report
+    out = out or sys.stdout
+    memorySizeMB = record['memory_mb']
+    vmcpulimit = "None" if record['cpu_limit_mhz'] is None else "{} Mhz".format(record['cpu_limit_mhz'])
+    vmmemlimit = "None" if record['mem_limit_mb'] is None else "{} MB".format(record['mem_limit_mb'])
+    vmcpures = "None" if record['cpu_reservation_mhz'] is None else "{} Mhz".format(record['cpu_reservation_mhz'])
+    vmmemres = "None" if record['mem_reservation_mb'] is None else "{} MB".format(record['mem_reservation_mb'])
+
+    print('\nNOTE: Any VM statistics are averages of the last {} minutes{}\n'.format(float(record['interval']),
+                                                                               SampleNote(record['interval'])),
+          file=out)
+    print('Server Name                    :', record['vm'], file=out)
+    if record['vcenter']:
+        print('vCenter                        :', record['vcenter'], file=out)
+    print('Description                    :', record['description'], file=out)
+    print('Guest                          :', record['guest'], file=out)
+    if record['snapshots']:
+        print('Snapshot Status                : Snapshots present', file=out)
+    else:
+        print('Snapshot Status                : No Snapshots', file=out)
+    print('VM .vmx Path                   :', record['vmx_path'], file=out)
+    for diskNumber, each_disk in enumerate(record['disks']):
+        print('Virtual Disks                  :' if diskNumber == 0 else '                                ',
+              DiskText(each_disk), file=out)
+    for nicNumber, each_vnic in enumerate(record['nics']):
+        print('Virtual NIC(s)                 :' if nicNumber == 0 else '                                ',
+              NicText(each_vnic), file=out)
+    print('[VM] Limits                    : CPU: {}, Memory: {}'.format(vmcpulimit, vmmemlimit), file=out)
+    print('[VM] Reservations              : CPU: {}, Memory: {}'.format(vmcpures, vmmemres), file=out)
+    print('[VM] Number of vCPUs           :', record['num_cpu'], file=out)
+    interval = record['interval']
+    print('[VM] CPU Ready                 :', Figure(interval, 'Average {:.1f} %, Maximum {:.1f} %, 95th percentile '
+                                                               '{:.1f} %', record['cpu_ready_avg_pct'],
+                                                   record['cpu_ready_max_pct'], record['cpu_ready_p95_pct']), file=out)
+    print('[VM] CPU (%)                   :', Figure(interval, '{:.0f} %', record['cpu_usage_pct']), file=out)
+    print('[VM] Memory                    : {} MB ({:.1f} GB)'.format(memorySizeMB, (float(memorySizeMB) / 1024)),
+          file=out)
+    for label, key in (('[VM] Memory Shared             :', 'mem_shared_mb'),
+                       ('[VM] Memory Balloon            :', 'mem_balloon_mb'),
+                       ('[VM] Memory Swapped            :', 'mem_swapped_mb'),
+                       ('[VM] Memory Active             :', 'mem_active_mb')):
+        print(label, Figure(interval, '{:.0f} %, {:.0f} MB', (record[key] / memorySizeMB) * 100, record[key]),
+              file=out)
+    print('[VM] Datastore Average IO      :', Figure(interval, 'Read: {:.0f} IOPS, Write: {:.0f} IOPS',
+                                                   record['datastore_read_iops'], record['datastore_write_iops']),
+          file=out)
+    print('[VM] Datastore Average Latency :', Figure(interval, 'Read: {:.0f} ms, Write: {:.0f} ms',
+                                                   record['datastore_read_latency_ms'],
+                                                   record['datastore_write_latency_ms']), file=out)
+    print('[VM] Overall Network Usage     :', Figure(interval, 'Transmitted {:.3f} Mbps, Received {:.3f} Mbps',
+                                                   record['net_tx_mbps'], record['net_rx_mbps']), file=out)
+    print('[Host] Name                    : {}'.format(record['host']), file=out)
     print('[Host] CPU Detail              : Processor Sockets: {}, Cores per Socket {}'.format(
-        summary.runtime.host.summary.hardware.numCpuPkgs,
-        (summary.runtime.host.summary.hardware.numCpuCores / summary.runtime.host.summary.hardware.numCpuPkgs)))
-    print('[Host] CPU Type                : {}'.format(summary.runtime.host.summary.hardware.cpuModel))
+        record['host_sockets'], record['host_cores_per_socket']), file=out)
+    print('[Host] CPU Type                : {}'.format(record['host_cpu_model']), file=out)
     print('[Host] CPU Usage               : Used: {} Mhz, Total: {} Mhz'.format(
-        summary.runtime.host.summary.quickStats.overallCpuUsage,
-        (summary.runtime.host.summary.hardware.cpuMhz * summary.runtime.host.summary.hardware.numCpuCores)))
+        record['host_cpu_used_mhz'], record['host_cpu_total_mhz']), file=out)
     print('[Host] Memory Usage            : Used: {:.0f} GB, Total: {:.0f} GB\n'.format(
-        (float(summary.runtime.host.summary.quickStats.overallMemoryUsage) / 1024),
-        (float(summary.runtime.host.summary.hardware.memorySize) / 1024 / 1024 / 1024)))
+        record['host_mem_used_gb'], record['host_mem_total_gb']), file=out)
+
+
+def RollupVms(vmRecords, vmCount):
+    # Totals over the VM records of one host or cluster, with the VMs waiting longest for CPU first
+    topReady = heapq.nlargest(ROLLUP_TOP, vmRecords, key=lambda record: record['cpu_ready_avg_pct'])
+    return OrderedDict([
+        ('vms', vmCount),
+        ('vms_reported', len(vmRecords)),
+        ('vcpus', sum(record['num_cpu'] for record in vmRecords)),
+        ('vm_memory_mb', sum(record['memory_mb'] for record in vmRecords)),
+        ('vm_cpu_ready_avg_pct', sum(record['cpu_ready_avg_pct'] for record in vmRecords) / max(1, len(vmRecords))),
+        ('vm_balloon_mb', sum(record['mem_balloon_mb'] for record in vmRecords)),
+        ('vm_swapped_mb', sum(record['mem_swapped_mb'] for record in vmRecords)),
+        ('datastore_read_iops', sum(record['datastore_read_iops'] for record in vmRecords)),
+        ('datastore_write_iops', sum(record['datastore_write_iops'] for record in vmRecords)),
+        ('datastore_read_latency_ms', max([record['datastore_read_latency_ms'] for record in vmRecords] + [0])),
+        ('datastore_write_latency_ms', max([record['datastore_write_latency_ms'] for record in vmRecords] + [0])),
+        ('net_tx_mbps', sum(record['net_tx_mbps'] for record in vmRecords)),
+        ('net_rx_mbps', sum(record['net_rx_mbps'] for record in vmRecords)),
+        ('top_cpu_ready', [OrderedDict([('vm', record['vm']), ('cpu_ready_avg_pct', record['cpu_ready_avg_pct']),
+                                        ('cpu_ready_max_pct', record['cpu_ready_max_pct'])])
+                           for record in topReady]),
+    ])
+
 
+def HostRecord(host, properties, hostMetrics, vmRecords, vchtime, interval, cluster=None, vcenter=None):
+    # One host from its own perf counters and the records of the VMs running on it
+    hostSnapshot = properties[host]
+    record = OrderedDict([
+        ('level', 'host'),
+        ('timestamp', vchtime.isoformat()),
+        ('interval', interval),
+        ('vcenter', vcenter),
+        ('cluster', cluster),
+        ('name', hostSnapshot.name),
+        ('moref', host._moId),
+        ('hosts', 1),
+        ('cpu_model', hostSnapshot.cpuModel),
+        ('sockets', hostSnapshot.numCpuPkgs),
+        ('cores', hostSnapshot.numCpuCores),
+        ('cpu_total_mhz', hostSnapshot.cpuMhz * hostSnapshot.numCpuCores),
+        ('cpu_used_mhz', hostSnapshot.cpuUsage),
+        ('mem_total_gb', float(hostSnapshot.memorySize) / 1024 / 1024 / 1024),
+        ('mem_used_gb', float(hostSnapshot.memoryUsage) / 1024),
+        ('cpu_usage_pct', None),
+        ('mem_usage_pct', None),
+        ('balloon_mb', None),
+        ('swap_used_mb', None),
+        ('net_usage_mbps', None),
+    ])
+    if hostMetrics:
+        record['cpu_usage_pct'] = hostMetrics['cpu.usage.average']['mean'] / 100
+        record['mem_usage_pct'] = hostMetrics['mem.usage.average']['mean'] / 100
+        record['balloon_mb'] = hostMetrics['mem.vmmemctl.average']['mean'] / 1024
+        record['swap_used_mb'] = hostMetrics['mem.swapused.average']['mean'] / 1024
+        record['net_usage_mbps'] = hostMetrics['net.usage.average']['mean'] * 8 / 1024
+    record.update(RollupVms(vmRecords, len(hostSnapshot.vms)))
+    return record
 
-def StatCheck(perf_dict, counter_name):
-    counter_key = perf_dict[counter_name]
-    return counter_key
 
+def ClusterRecord(cluster, hostRecords, vmRecords, vchtime, interval, vcenter=None):
+    # Capacity and usage added up over the hosts, the VM totals over every VM in the cluster
+    record = OrderedDict([
+        ('level', 'cluster'),
+        ('timestamp', vchtime.isoformat()),
+        ('interval', interval),
+        ('vcenter', vcenter),
+        ('cluster', cluster),
+        ('name', cluster),
+        ('hosts', len(hostRecords)),
+    ])
+    for key in ('cores', 'cpu_total_mhz', 'cpu_used_mhz', 'mem_total_gb', 'mem_used_gb', 'balloon_mb',
+                'swap_used_mb', 'net_usage_mbps'):
+        values = [hostRecord[key] for hostRecord in hostRecords if hostRecord[key] is not None]
+        record[key] = sum(values) if values else None
+    record.update(RollupVms(vmRecords, sum(hostRecord['vms'] for hostRecord in hostRecords)))
+    return record
+
+
+def PrintRollupInfo(record, out=None):
+    # Text report for a host or cluster record
+    out = out or sys.stdout
+    print('\nNOTE: Any statistics are averages of the last {} minutes{}\n'.format(float(record['interval']),
+                                                                            SampleNote(record['interval'])), file=out)
+    if record['level'] == 'cluster':
+        print('Cluster Name                   :', record['name'], file=out)
+        print('Hosts                          :', record['hosts'], file=out)
+    else:
+        print('Host Name                      :', record['name'], file=out)
+        if record['cluster']:
+            print('Cluster                        :', record['cluster'], file=out)
+        print('CPU Detail                     : Processor Sockets: {}, Cores: {}, {}'.format(
+            record['sockets'], record['cores'], record['cpu_model']), file=out)
+    if record['vcenter']:
+        print('vCenter                        :', record['vcenter'], file=out)
+    print('CPU Usage                      : Used: {} Mhz, Total: {} Mhz'.format(
+        record['cpu_used_mhz'], record['cpu_total_mhz']), file=out)
+    print('Memory Usage                   : Used: {:.0f} GB, Total: {:.0f} GB'.format(
+        record['mem_used_gb'], record['mem_total_gb']), file=out)
+    interval = record['interval']
+    if record['level'] == 'host' and record['cpu_usage_pct'] is not None:
+        print('[Host] CPU (%)                 :', Figure(interval, '{:.0f} %', record['cpu_usage_pct']), file=out)
+        print('[Host] Memory (%)              :', Figure(interval, '{:.0f} %', record['mem_usage_pct']), file=out)
+    if record['balloon_mb'] is not None:
+        print('[Host] Memory Balloon          :', Figure(interval, '{:.0f} MB', record['balloon_mb']), file=out)
+        print('[Host] Swap Used               :', Figure(interval, '{:.0f} MB', record['swap_used_mb']), file=out)
+        print('[Host] Network Usage           :', Figure(interval, '{:.3f} Mbps', record['net_usage_mbps']),
+              file=out)
+    print('[VMs] Count                    : {} ({} reported), {} vCPUs, {} MB'.format(
+        record['vms'], record['vms_reported'], record['vcpus'], record['vm_memory_mb']), file=out)
+    print('[VMs] CPU Ready                :', Figure(interval, 'Average {:.1f} %', record['vm_cpu_ready_avg_pct']),
+          file=out)
+    print('[VMs] Memory Balloon           :', Figure(interval, '{:.0f} MB', record['vm_balloon_mb']), file=out)
+    print('[VMs] Memory Swapped           :', Figure(interval, '{:.0f} MB', record['vm_swapped_mb']), file=out)
+    print('[VMs] Datastore Total IO       :', Figure(interval, 'Read: {:.0f} IOPS, Write: {:.0f} IOPS',
+                                                   record['datastore_read_iops'], record['datastore_write_iops']),
+          file=out)
+    print('[VMs] Datastore Worst Latency  :', Figure(interval, 'Read: {:.0f} ms, Write: {:.0f} ms',
+                                                   record['datastore_read_latency_ms'],
+                                                   record['datastore_write_latency_ms']), file=out)
+    print('[VMs] Total Network Usage      :', Figure(interval, 'Transmitted {:.3f} Mbps, Received {:.3f} Mbps',
+                                                   record['net_tx_mbps'], record['net_rx_mbps']), file=out)
+    for rank, top in enumerate(record['top_cpu_ready']):
+        print('[VMs] Top CPU Ready            :' if rank == 0 else '                                ',
+              '{}. {} - Average {:.1f} %, Maximum {:.1f} %'.format(rank + 1, top['vm'], top['cpu_ready_avg_pct'],
+                                                                 top['cpu_ready_max_pct']), file=out)
+    print('', file=out)
+
+
+def PromLabels(record):
+    # moref keeps VMs that share a name apart, as the exposition format rejects two series with the same labels
+    labels = [('vcenter', record['vcenter']), ('vm', record['vm']), ('moref', record['moref']),
+              ('host', record['host'])]
+    return ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                    for name, value in labels if value is not None)
+
+
+def PromFamilies(records):
+    # The exposition format needs every line of a metric family in one group, so each family goes out with the
+    # samples of every record before the next one starts
+    for name, description, key, scale in PROM_METRICS:
+        yield '# HELP {} {}'.format(name, description)
+        yield '# TYPE {} gauge'.format(name)
+        for record in records:
+            for line in PromSamples(record, name):
+                yield line
+
+
+def PromSamples(record, name=None):
+    # One line per metric, or only the named metric
+    labels = PromLabels(record)
+    for metricName, description, key, scale in PROM_METRICS:
+        if name is None or metricName == name:
+            yield '{}{{{}}} {!r}'.format(metricName, labels, float(record[key] * scale))
+
+
+class ReportWriter(object):
+    """
+    Renders VM records in one of the --format output formats, writing and flushing each record as it arrives
+    so nothing is held back for the whole sweep.  prom is the exception: its metric families can't be split per
+    VM, so those records are kept until Close().
+    """
 
-def GetProperties(content, viewType, props, specType):
-    # Build a view and get basic properties for all Virtual Machines
-    objView = content.viewManager.CreateContainerView(content.rootFolder, viewType, True)
-    tSpec = vim.PropertyCollector.TraversalSpec(name='tSpecName', path='view', skip=False, type=vim.view.ContainerView)
+    def __init__(self, format, out=None):
+        self.format = format
+        self.out = out or sys.stdout
+        self.records = 0
+        self.csvWriter = None
+        self.promRecords = []
+
+    def Write(self, record, render=PrintVmInfo):
+        if self.format == 'text':
+            render(record, self.out)
+        elif self.format == 'json':
+            # A single JSON array, opened with the first record and closed by Close()
+            self.out.write('[\n' if self.records == 0 else ',\n')
+            self.out.write(json.dumps(JsonValue(record), allow_nan=False))
+        elif self.format == 'jsonl':
+            self.out.write(json.dumps(JsonValue(record), allow_nan=False) + '\n')
+        elif self.format == 'csv':
+            row = JsonValue(record)
+            row['disks'] = '; '.join(DiskText(disk) for disk in record['disks'])
+            row['nics'] = '; '.join(NicText(nic) for nic in record['nics'])
+            if self.csvWriter is None:
+                self.csvWriter = csv.DictWriter(self.out, fieldnames=list(row.keys()))
+                self.csvWriter.writeheader()
+            self.csvWriter.writerow(row)
+        elif self.format == 'prom':
+            self.promRecords.append(record)
+        self.records += 1
+        self.out.flush()
+
+    def Section(self, title):
+        # Separators between watch mode ticks only make sense in the text report
+        if self.format == 'text':
+            print('\n==== {} ===='.format(title), file=self.out)
+            self.out.flush()
+
+    def Close(self):
+        if self.format == 'json':
+            self.out.write('\n]\n' if self.records else '[]\n')
+            self.out.flush()
+        elif self.format == 'prom' and self.promRecords:
+            self.out.write('\n'.join(PromFamilies(self.promRecords)) + '\n')
+            self.out.flush()
+
+
+def UncollectedNote(uncollected, interval):
+    return 'NOTE: The statistics level{} doesn\'t keep {}, so they are reported as not collected'.format(
+        SampleNote(interval).replace(' of ', ' for ', 1), ', '.join(uncollected))
+
+
+def GetObjectProperties(content, objs, props, specType):
+    # Get properties for a known list of managed objects rather than everything in a view
+    if not objs:
+        # A FilterSpec needs at least one object
+        return []
+    oSpecs = [vim.PropertyCollector.ObjectSpec(obj=obj, skip=False) for obj in objs]
     pSpec = vim.PropertyCollector.PropertySpec(all=False, pathSet=props, type=specType)
-    oSpec = vim.PropertyCollector.ObjectSpec(obj=objView, selectSet=[tSpec], skip=False)
-    pfSpec = vim.PropertyCollector.FilterSpec(objectSet=[oSpec], propSet=[pSpec], reportMissingObjectsInResults=False)
-    retOptions = vim.PropertyCollector.RetrieveOptions()
-    totalProps = []
-    retProps = content.propertyCollector.RetrievePropertiesEx(specSet=[pfSpec], options=retOptions)
-    totalProps += retProps.objects
-    while retProps.token:
-        retProps = content.propertyCollector.ContinueRetrievePropertiesEx(token=retProps.token)
-        totalProps += retProps.objects
-    objView.Destroy()
-    # Turn the output in retProps into a usable dictionary of values
-    gpOutput = []
-    for eachProp in totalProps:
-        propDic = {}
-        for prop in eachProp.propSet:
-            propDic[prop.name] = prop.val
-        propDic['moref'] = eachProp.obj
-        gpOutput.append(propDic)
-    return gpOutput
+    pfSpec = vim.PropertyCollector.FilterSpec(objectSet=oSpecs, propSet=[pSpec], reportMissingObjectsInResults=False)
+    return RetrieveProperties(content, pfSpec)
 
 
-def main():
-    args = GetArgs()
-    try:
-        vmnames = args.vm
-        si = None
-        if args.password:
-            password = args.password
+def FindVms(content, vmnames):
+    # UUIDs are looked up through the SearchIndex, so the cost doesn't depend on the size of the inventory.  Names
+    # and globs need the name of every VM: the SearchIndex only finds VMs by guest DNS name, which needs VMware
+    # Tools, can differ from the VM name and says nothing about other VMs with the same name.  A one-shot run reads
+    # them in a single RetrievePropertiesEx pass, as a VmIndex only pays off when it outlives the lookup
+    names = SplitVmNames(vmnames)
+    candidates = {}
+    for name in names:
+        if UUID_PATTERN.match(name):
+            candidates[name] = (content.searchIndex.FindAllByUuid(uuid=name, vmSearch=True, instanceUuid=True) +
+                                content.searchIndex.FindAllByUuid(uuid=name, vmSearch=True, instanceUuid=False))
+    candidateProps = {}
+    allCandidates = list(set(vm for name in candidates for vm in candidates[name]))
+    for vm in GetObjectProperties(content, allCandidates, ['name', 'runtime.powerState'], vim.VirtualMachine):
+        candidateProps[vm.moref] = vm
+
+    byName = {}
+    if len(candidates) < len(names):
+        for vm in GetProperties(content, [vim.VirtualMachine], ['name', 'runtime.powerState'], vim.VirtualMachine):
+            byName.setdefault(vm.name, []).append(vm)
+    found = []
+    seen = set()
+    for name in names:
+        if name in candidates:
+            matches = [candidateProps[vm] for vm in candidates[name] if vm in candidateProps]
         else:
-            password = getpass.getpass(prompt="Enter password for host {} and user {}: ".format(args.host, args.user))
-        try:
+            matches = MatchNames(byName, name)
+        for vm in matches:
+            if vm.moref not in seen:
+                seen.add(vm.moref)
+                found.append(vm)
+    return found
+
+
+def Connect(args, password, logout=True):
+    si = None
+    try:
+        with PROFILE.Stage('connect'):
             if args.cert_check_skip:
                 context = ssl._create_unverified_context()
                 si = SmartConnect(host=args.host,
@@ -242,38 +851,751 @@ def main():
                                   user=args.user,
                                   pwd=password,
                                   port=int(args.port))
-        except IOError as e:
-            pass
+    except IOError as e:
+        pass
+    if si and logout:
+        atexit.register(Disconnect, si)
+    return si
+
+
+def GetPassword(args):
+    # Prompted for at most once, and not at all when --session-cache reattaches to the previous session
+    if not args.password:
+        args.password = getpass.getpass(prompt="Enter password for host {} and user {}: ".format(args.host, args.user))
+    return args.password
+
+
+def Login(args, session=0):
+    # Returns the service instance and its content, or (None, None) if the login failed.  With --session-cache the
+    # session is left logged in at exit and the next run reattaches to it, only logging in again once vCenter has
+    # expired it.  Each extra --workers session is kept under its own number
+    if not args.session_cache:
+        si = Connect(args, GetPassword(args))
         if not si:
-            print('Could not connect to the specified host using specified username and password')
+            return None, None
+        with PROFILE.Stage('connect'):
+            return si, si.RetrieveContent()
+    si, content = ResumeSession(args, session)
+    if not si:
+        si = Connect(args, GetPassword(args), logout=False)
+        if not si:
+            return None, None
+        with PROFILE.Stage('connect'):
+            content = si.RetrieveContent()
+        SaveSession(args, si, content, session)
+    return si, content
+
+
+def SessionCacheFile(args, session=0):
+    key = re.sub(r'[^\w.@-]', '_', '{}-{}-{}'.format(args.host, args.port, args.user))
+    if session:
+        key = '{}-{}'.format(key, session)
+    return os.path.join(PERF_CACHE_DIR, 'session-{}.json'.format(key))
+
+
+def ResumeSession(args, session=0):
+    cache_file = SessionCacheFile(args, session)
+    try:
+        # The session id is as good as the password until it expires, so a file anyone else can read isn't used
+        if os.stat(cache_file).st_mode & 0o077:
+            return None, None
+        with open(cache_file) as cache:
+            cached = json.load(cache)
+    except (IOError, OSError, ValueError):
+        return None, None
+
+    # Built straight on the cached session, API version and service content, skipping SmartConnect's version
+    # lookup, Login and RetrieveContent, so checking the session is still logged in is the only round trip
+    try:
+        with PROFILE.Stage('connect'):
+            stub = SoapAdapter.SoapStubAdapter(host=args.host, port=int(args.port), version=cached['version'],
+                                               sessionId=cached['session'],
+                                               sslContext=ssl._create_unverified_context() if args.cert_check_skip
+                                               else None)
+            content = SoapAdapter.Deserialize(cached['content'].encode('utf-8'), vim.ServiceInstanceContent,
+                                              stub=stub)
+            if not content.sessionManager.currentSession:
+                return None, None
+    except (KeyError, IOError, ExpatError, vmodl.MethodFault):
+        return None, None
+    return vim.ServiceInstance('ServiceInstance', stub), content
+
+
+def SaveSession(args, si, content, session=0):
+    cache_file = SessionCacheFile(args, session)
+    stub = si._stub
+    try:
+        if not os.path.isdir(PERF_CACHE_DIR):
+            os.makedirs(PERF_CACHE_DIR, 0o700)
+        # Written owner only and moved into place, so the session id is never readable by anyone else
+        fd = os.open(cache_file + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        os.fchmod(fd, 0o600)
+        with os.fdopen(fd, 'w') as cache:
+            json.dump({'session': stub.GetSessionId(), 'version': stub.version,
+                       'content': SoapAdapter.Serialize(content, version=stub.version).decode('utf-8')}, cache)
+        os.replace(cache_file + '.tmp', cache_file)
+    except (IOError, OSError):
+        pass
+
+
+class SampleWindow(object):
+    """
+    Ring buffer of the last statInt 20s samples of every counter instance for each VM.  Watch mode keeps one
+    between ticks so it only has to ask vCenter for the samples taken since the previous tick.
+    """
+
+    def __init__(self, statInt):
+        self.statInt = statInt
+        self.series = {}
+        self.lastSample = {}
+
+    def QuerySpec(self, vm, vchtime, metricIds, interval):
+        # Every tick ends its window a minute before the vCenter clock like the first one does, so the minute vCenter
+        # may still be writing is never read.  None when no new sample can have been written since the last tick
+        lastSample = self.lastSample.get(vm)
+        endTime = vchtime - timedelta(minutes=1)
+        if lastSample is None:
+            startTime = vchtime - timedelta(minutes=(interval + 1))
+            return vim.PerformanceManager.QuerySpec(intervalId=20, entity=vm, metricId=metricIds,
+                                                    startTime=startTime, endTime=endTime)
+        # startTime is exclusive, so only samples newer than the last one seen come back
+        newSamples = int((endTime - lastSample).total_seconds() // 20)
+        if newSamples < 1:
+            return None
+        return vim.PerformanceManager.QuerySpec(intervalId=20, entity=vm, metricId=metricIds, startTime=lastSample,
+                                                endTime=endTime, maxSample=min(newSamples, self.statInt))
+
+    def Add(self, entityMetric):
+        vm = entityMetric.entity
+        lastSample = self.lastSample.get(vm)
+        timestamps = [sampleInfo.timestamp for sampleInfo in entityMetric.sampleInfo or []]
+        newSamples = [sample for sample, timestamp in enumerate(timestamps)
+                      if lastSample is None or timestamp > lastSample]
+        vmSeries = self.series.setdefault(vm, OrderedDict())
+        for series in entityMetric.value:
+            key = (series.id.counterId, series.id.instance)
+            if key not in vmSeries:
+                vmSeries[key] = deque(maxlen=self.statInt)
+            vmSeries[key].extend(series.value[sample] for sample in newSamples if sample < len(series.value))
+        if timestamps:
+            self.lastSample[vm] = max(timestamps)
+
+    def Stats(self, vm):
+        # Same shape as SplitPerfResults so VmRecord can't tell the difference
+        stats = {}
+        for (counterId, instance), samples in self.series.get(vm, {}).items():
+            stats.setdefault(counterId, []).append(list(samples))
+        return stats
+
+
+def WatchVms(si, content, vchtime, perf_dict, vms, properties, args, writer):
+    # The vCenter clock is read once and then tracked locally so a tick costs just the QueryPerf calls and a
+    # refresh of the VM and host properties
+    clockOffset = vchtime - datetime.now(vchtime.tzinfo)
+    window = SampleWindow(args.interval * 3)
+    metricIds = VmMetricIds(perf_dict)
+    chunkSize = GetChunkSize(content, args.chunk_size, len(metricIds))
+    chunks = [vms[chunkStart:chunkStart + chunkSize] for chunkStart in range(0, len(vms), chunkSize)]
+    firstTick = True
+    try:
+        while True:
+            tickStart = time.time()
+            try:
+                # The clock moves on every tick, even when the first one found no samples at all
+                if not firstTick:
+                    vchtime = datetime.now(vchtime.tzinfo) + clockOffset
+                    properties = PrefetchProperties(content, vms, VM_PROPERTIES, HOST_PROPERTIES)
+                firstTick = False
+                writer.Section(vchtime)
+                for chunk in chunks:
+                    querySpecs = [querySpec for querySpec in (window.QuerySpec(vm, vchtime, metricIds, args.interval)
+                                                              for vm in chunk) if querySpec]
+                    try:
+                        if querySpecs:
+                            for entityMetric in content.perfManager.QueryPerf(querySpec=querySpecs):
+                                window.Add(entityMetric)
+                    except vim.fault.NotAuthenticated:
+                        raise
+                    except vmodl.MethodFault as e:
+                        print('ERROR: Could not get performance results: {}'.format(e.msg), file=sys.stderr)
+                    vmsWithStats = [vm for vm in chunk if window.Stats(vm)]
+                    chunkMetrics = dict(zip(vmsWithStats, ReduceStats([window.Stats(vm) for vm in vmsWithStats],
+                                                                      perf_dict)))
+                    for vm in chunk:
+                        if vm not in chunkMetrics:
+                            print('ERROR: Performance results empty for {}.  TIP: Check time drift on source and '
+                                  'vCenter server'.format(properties[vm].name), file=sys.stderr)
+                            continue
+                        try:
+                            writer.Write(VmRecord(vm, content, vchtime, args.interval, perf_dict, properties,
+                                                  chunkMetrics[vm]))
+                        except Exception as e:
+                            print('ERROR: Could not report on {}: {}'.format(properties[vm].name,
+                                                                             getattr(e, 'msg', None) or str(e)),
+                                  file=sys.stderr)
+            except vim.fault.NotAuthenticated:
+                # vCenter expired the session during a long watch, log in again and carry on with the next tick
+                print('ERROR: Session to {} expired, logging in again'.format(args.host), file=sys.stderr)
+                loggedIn = Login(args)
+                if loggedIn[0]:
+                    si, content = loggedIn
+            time.sleep(max(0, args.watch - (time.time() - tickStart)))
+    except KeyboardInterrupt:
+        pass
+
+
+def FindHostGroups(content, hostnames, clusternames):
+    # Resolve --esxi and --cluster names or globs to a list of (cluster name or None, [host morefs])
+    groups = []
+    if clusternames:
+        clusters = GetProperties(content, [vim.ClusterComputeResource], ['name', 'host'], vim.ClusterComputeResource)
+        for clustername in SplitVmNames(clusternames):
+            for cluster in sorted(clusters, key=lambda cluster: cluster.name):
+                if fnmatch.fnmatchcase(cluster.name, clustername) and \
+                        cluster.name not in [name for name, hosts in groups]:
+                    groups.append((cluster.name, list(cluster.hosts)))
+    if hostnames:
+        hosts = GetProperties(content, [vim.HostSystem], ['name'], vim.HostSystem)
+        found = []
+        for hostname in SplitVmNames(hostnames):
+            found += [host.moref for host in sorted(hosts, key=lambda host: host.name)
+                      if fnmatch.fnmatchcase(host.name, hostname) and host.moref not in found]
+        groups += [(None, [host]) for host in found]
+    return groups
+
+
+def RollupHosts(content, vchtime, perf_dict, args, writer, store=None):
+    # Host and cluster reports.  Each host's properties and perf counters are fetched once, however many VMs run
+    # on it, and the VMs themselves go through the same chunked collection as a VM report
+    groups = FindHostGroups(content, args.esxi, args.cluster)
+    if not groups:
+        print('ERROR: No hosts or clusters matched', file=sys.stderr)
+        return -1
+    hosts = []
+    for cluster, groupHosts in groups:
+        hosts += [host for host in groupHosts if host not in hosts]
+
+    properties = dict((host.moref, host) for host in
+                      GetObjectProperties(content, hosts, HOST_PROPERTIES + ['vm'], vim.HostSystem))
+    hostVms = [vm for host in hosts if host in properties for vm in properties[host].vms]
+    for vm in GetObjectProperties(content, hostVms, VM_PROPERTIES + ['runtime.powerState'], vim.VirtualMachine):
+        properties[vm.moref] = vm
+    vms = [vm for vm in hostVms if vm in properties and properties[vm].powerState == "poweredOn"]
+
+    # Host counters in one batched query
+    hostMetricIds = VmMetricIds(perf_dict, HOST_COUNTERS)
+    hostStats = dict(BuildBulkQuery(content, vchtime, hostMetricIds, hosts, args.interval,
+                                    GetChunkSize(content, 0, len(hostMetricIds))))
+    hostsWithStats = [host for host in hosts if hostStats.get(host)]
+    hostMetrics = dict(zip(hostsWithStats, ReduceStats([hostStats[host] for host in hostsWithStats], perf_dict,
+                                                       HOST_COUNTERS)))
+
+    workers = max(1, min(args.workers, SESSION_CONCURRENCY))
+    metricIds = VmMetricIds(perf_dict)
+    chunkSize = GetChunkSize(content, args.chunk_size, len(metricIds))
+    if workers > 1:
+        chunkSize = max(1, min(chunkSize, -(-len(vms) // workers)))
+    chunks = [vms[chunkStart:chunkStart + chunkSize] for chunkStart in range(0, len(vms), chunkSize)]
+    sessionPool = SessionPool([content])
+    vmRecords = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(CollectVms, sessionPool, vchtime, metricIds, chunk, args.interval, perf_dict,
+                                   store) for chunk in chunks]
+        for chunk, future in zip(chunks, futures):
+            try:
+                chunkMetrics = future.result()
+            except Exception as e:
+                print('ERROR: Could not get performance results: {}'.format(getattr(e, 'msg', None) or str(e)),
+                      file=sys.stderr)
+                continue
+            for vm in chunk:
+                if vm in chunkMetrics:
+                    try:
+                        vmRecords[vm] = VmRecord(vm, content, vchtime, args.interval, perf_dict, properties,
+                                                 chunkMetrics[vm])
+                    except Exception as e:
+                        print('ERROR: Could not report on {}: {}'.format(properties[vm].name,
+                                                                         getattr(e, 'msg', None) or str(e)),
+                              file=sys.stderr)
+
+    for cluster, groupHosts in groups:
+        hostRecords = []
+        for host in groupHosts:
+            if host not in properties:
+                continue
+            hostVmRecords = [vmRecords[vm] for vm in properties[host].vms if vm in vmRecords]
+            hostRecords.append(HostRecord(host, properties, hostMetrics.get(host), hostVmRecords, vchtime,
+                                          args.interval, cluster))
+            writer.Write(hostRecords[-1], PrintRollupInfo)
+        if cluster:
+            clusterVmRecords = [vmRecords[vm] for host in groupHosts if host in properties
+                                for vm in properties[host].vms if vm in vmRecords]
+            writer.Write(ClusterRecord(cluster, hostRecords, clusterVmRecords, vchtime, args.interval),
+                         PrintRollupInfo)
+    return 0
+
+
+def ScreenLatency(sessionPool, vchtime, metricIds, vms, errors=None):
+    # Latest 20s sample of the datastore latency counters for a chunk of VMs, the worst instance of either counter.
+    # A faulted chunk is retried one VM at a time like CollectVms does
+    content = sessionPool.Content()
+
+    def Query(chunk):
+        querySpecs = [vim.PerformanceManager.QuerySpec(intervalId=20, entity=vm, metricId=metricIds, maxSample=1,
+                                                       endTime=vchtime) for vm in chunk]
+        latency = {}
+        for entityMetric in content.perfManager.QueryPerf(querySpec=querySpecs):
+            values = [series.value[-1] for series in entityMetric.value if series.value]
+            if values:
+                latency[entityMetric.entity] = max(values)
+        return latency
+    return QueryChunk(Query, vms, errors)
+
+
+def TopVms(content, vchtime, perf_dict, args, writer, store=None):
+    """
+    Rank the whole inventory by --by and report the worst --top N VMs.  Every powered on VM is scored cheaply
+    first, from summary.quickStats in one PropertyCollector pass (CPU demand the VM didn't get for cpu.ready,
+    swappedMemory for mem.swapped) or from a single latency sample per VM.  Only the TOP_SHORTLIST times N best
+    scores then get the full QueryPerf series, and are ranked again on those.
+    """
+    vms = [vm for vm in GetProperties(content, [vim.VirtualMachine], ['name', 'runtime.powerState',
+                                                                      'summary.quickStats'], vim.VirtualMachine)
+           if vm.powerState == "poweredOn"]
+    workers = max(1, min(args.workers, SESSION_CONCURRENCY))
+    sessionPool = SessionPool([content])
+    shortlistSize = args.top * TOP_SHORTLIST
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        if args.by == 'datastore.latency':
+            latencyIds = [vim.PerformanceManager.MetricId(counterId=StatCheck(perf_dict, counter_name), instance='*')
+                          for counter_name in ('datastore.totalReadLatency.average',
+                                               'datastore.totalWriteLatency.average')]
+            morefs = [vm.moref for vm in vms]
+            chunkSize = GetChunkSize(content, args.chunk_size, len(latencyIds))
+            chunks = [morefs[chunkStart:chunkStart + chunkSize] for chunkStart in range(0, len(morefs), chunkSize)]
+            screenErrors = {}
+            futures = [executor.submit(ScreenLatency, sessionPool, vchtime, latencyIds, chunk, screenErrors)
+                       for chunk in chunks]
+            # A chunk that still faults only leaves its VMs out of the ranking
+            latency = {}
+            for chunk, future in zip(chunks, futures):
+                try:
+                    latency.update(future.result())
+                except vim.fault.NotAuthenticated:
+                    raise
+                except vmodl.MethodFault as e:
+                    for vm in chunk:
+                        screenErrors[vm] = e.msg or str(e)
+            names = dict((vm.moref, vm.name) for vm in vms)
+            for vm, error in screenErrors.items():
+                print('ERROR: Could not screen the datastore latency of {}, leaving it out: {}'.format(names[vm],
+                                                                                                     error),
+                      file=sys.stderr)
+            scores = ((latency[vm.moref], vm.moref) for vm in vms if vm.moref in latency)
+        elif args.by == 'mem.swapped':
+            scores = ((vm.swappedMemory or 0, vm.moref) for vm in vms)
+        else:
+            scores = (((vm.cpuDemand or 0) -
+                       (vm.cpuUsage or 0), vm.moref) for vm in vms)
+        shortlist = [vm for score, vm in heapq.nlargest(shortlistSize, scores, key=lambda scored: scored[0])]
+
+        properties = PrefetchProperties(content, shortlist, VM_PROPERTIES, HOST_PROPERTIES)
+        metricIds = VmMetricIds(perf_dict)
+        chunkSize = GetChunkSize(content, args.chunk_size, len(metricIds))
+        if workers > 1:
+            chunkSize = max(1, min(chunkSize, -(-len(shortlist) // workers)))
+        chunks = [shortlist[chunkStart:chunkStart + chunkSize]
+                  for chunkStart in range(0, len(shortlist), chunkSize)]
+        vmErrors = {}
+        futures = [executor.submit(CollectVms, sessionPool, vchtime, metricIds, chunk, args.interval, perf_dict,
+                                   store, vmErrors) for chunk in chunks]
+
+        # Records only stay on the heap while they are among the worst N seen so far
+        top = []
+        collected = 0
+        for chunk, future in zip(chunks, futures):
+            try:
+                chunkMetrics = future.result()
+            except Exception as e:
+                print('ERROR: Could not get performance results: {}'.format(getattr(e, 'msg', None) or str(e)),
+                      file=sys.stderr)
+                continue
+            for vm in chunk:
+                if vm in vmErrors:
+                    print('ERROR: Could not get performance results for {}, leaving it out: {}'.format(
+                        properties[vm].name, vmErrors[vm]), file=sys.stderr)
+                if vm not in chunkMetrics:
+                    continue
+                record = VmRecord(vm, content, vchtime, args.interval, perf_dict, properties, chunkMetrics[vm])
+                # Ties go to the VM collected first
+                collected += 1
+                entry = (TopScore(record, args.by), -collected, record)
+                if len(top) < args.top:
+                    heapq.heappush(top, entry)
+                elif entry[0] > top[0][0]:
+                    heapq.heapreplace(top, entry)
+
+    for score, order, record in sorted(top, key=lambda entry: entry[:2], reverse=True):
+        writer.Write(record)
+    return 0
+
+
+def TopScore(record, by):
+    # What --by ranks the fully collected VMs on.  A counter the statistics level doesn't keep scores lowest, so
+    # the VMs stay in the order the quickStats screen shortlisted them
+    if by == 'datastore.latency':
+        score = max(record['datastore_read_latency_ms'], record['datastore_write_latency_ms'])
+    elif by == 'mem.swapped':
+        score = record['mem_swapped_mb']
+    else:
+        score = record['cpu_ready_avg_pct']
+    return float('-inf') if math.isnan(score) else score
+
+
+class MetricsCache(object):
+    """
+    Latest /metrics page rendered by the exporter's background collector.  Scrapes only read this, so any number of
+    Prometheus servers scraping at any rate cost vCenter nothing beyond the collector's own batched queries.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.body = None
+
+    def Set(self, body):
+        with self.lock:
+            self.body = body
+
+    def Get(self):
+        with self.lock:
+            return self.body
+
+
+def RenderExposition(records, errors, duration, collectTime):
+    # The same families as --format prom, followed by the collector's own gauges
+    lines = list(PromFamilies(records))
+    for name, description, value in (
+            ('vmstats_collector_vms', 'VMs reported by the last refresh', len(records)),
+            ('vmstats_collector_errors', 'VMs the last refresh could not collect', errors),
+            ('vmstats_collector_duration_seconds', 'Time the last refresh took', duration),
+            ('vmstats_collector_last_refresh_timestamp_seconds', 'When the last refresh finished', collectTime)):
+        lines.append('# HELP {} {}'.format(name, description))
+        lines.append('# TYPE {} gauge'.format(name))
+        lines.append('{} {!r}'.format(name, float(value)))
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+def CollectForever(si, content, vchtime, perf_dict, args, cache):
+    # Background collector for --exporter.  Every refresh picks up VMs that appeared or changed name through the
+    # VmIndex, queries the perf counters in chunks and swaps in the rendered page, keeping the previous page if the
+    # refresh fails
+    clockOffset = vchtime - datetime.now(vchtime.tzinfo)
+    metricIds = VmMetricIds(perf_dict)
+    workers = max(1, min(args.workers, SESSION_CONCURRENCY))
+    uuids = ','.join(name for name in SplitVmNames(args.vm) if UUID_PATTERN.match(name))
+    names = ','.join(name for name in SplitVmNames(args.vm) if not UUID_PATTERN.match(name))
+    store = SampleStore(args.store, content.about.instanceUuid or args.host) if args.store else None
+    index = None
+    with ThreadPoolExecutor(max_workers=workers) as executor, PROFILE.Stage('exporter'):
+        while True:
+            tickStart = time.time()
+            try:
+                if index is None:
+                    index = VmIndex(content)
+                else:
+                    index.Update()
+                vchtime = datetime.now(vchtime.tzinfo) + clockOffset
+                found = index.Find(names) + (FindVms(content, uuids) if uuids else [])
+                vms = []
+                for vm in found:
+                    if vm.powerState == "poweredOn" and vm.moref not in vms:
+                        vms.append(vm.moref)
+                properties = PrefetchProperties(content, vms, VM_PROPERTIES, HOST_PROPERTIES)
+
+                chunkSize = GetChunkSize(content, args.chunk_size, len(metricIds))
+                if workers > 1:
+                    chunkSize = max(1, min(chunkSize, -(-len(vms) // workers)))
+                chunks = [vms[chunkStart:chunkStart + chunkSize] for chunkStart in range(0, len(vms), chunkSize)]
+                sessionPool = SessionPool([content])
+                futures = [executor.submit(CollectVms, sessionPool, vchtime, metricIds, chunk, args.interval,
+                                           perf_dict, store) for chunk in chunks]
+                records = []
+                errors = 0
+                for chunk, future in zip(chunks, futures):
+                    try:
+                        chunkMetrics = future.result()
+                    except Exception as e:
+                        print('ERROR: Could not get performance results: {}'.format(getattr(e, 'msg', None) or str(e)),
+                              file=sys.stderr)
+                        errors += len(chunk)
+                        continue
+                    for vm in chunk:
+                        try:
+                            records.append(VmRecord(vm, content, vchtime, args.interval, perf_dict, properties,
+                                                    chunkMetrics[vm], vcenter=args.host))
+                        except Exception:
+                            errors += 1
+                cache.Set(RenderExposition(records, errors, time.time() - tickStart, time.time()))
+            except vim.fault.NotAuthenticated:
+                # vCenter expired the session, log in again and rebuild the index on the new session next time
+                print('ERROR: Session to {} expired, logging in again'.format(args.host), file=sys.stderr)
+                loggedIn = Login(args)
+                if loggedIn[0]:
+                    si, content = loggedIn
+                index = None
+            except Exception as e:
+                print('ERROR: Could not refresh metrics: {}'.format(getattr(e, 'msg', None) or str(e)),
+                      file=sys.stderr)
+            time.sleep(max(0, args.refresh - (time.time() - tickStart)))
+
+
+def ExporterApplication(cache):
+    def application(environ, start_response):
+        if environ.get('PATH_INFO', '/') != '/metrics':
+            start_response('404 Not Found', [('Content-Type', 'text/plain')])
+            return [b'Metrics are served at /metrics\n']
+        body = cache.Get()
+        if body is None:
+            start_response('503 Service Unavailable', [('Content-Type', 'text/plain')])
+            return [b'The first collection has not finished yet\n']
+        start_response('200 OK', [('Content-Type', 'text/plain; version=0.0.4; charset=utf-8'),
+                                  ('Content-Length', str(len(body)))])
+        return [body]
+    return application
+
+
+def ServeExporter(si, content, vchtime, perf_dict, args):
+    cache = MetricsCache()
+    collector = threading.Thread(target=CollectForever, args=(si, content, vchtime, perf_dict, args, cache))
+    collector.daemon = True
+    collector.start()
+    httpd = make_server(args.bind, args.exporter, ExporterApplication(cache), server_class=ThreadingWSGIServer)
+    print('Serving metrics on port {}, refreshed every {} seconds'.format(args.exporter, args.refresh),
+          file=sys.stderr)
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+async def SweepEndpoint(endpoint, args, executor, writer):
+    # Runs the whole report for one vCenter.  Every pyVmomi call blocks, so each one is handed to the executor
+    # and the per-endpoint semaphore keeps the number in flight on this vCenter's session within
+    # SESSION_CONCURRENCY.  Reports are printed from the event loop as each chunk completes
+    loop = asyncio.get_event_loop()
+    limit = asyncio.Semaphore(max(1, min(args.workers, SESSION_CONCURRENCY)))
+    host = endpoint['host']
+
+    async def Call(function, *callArgs):
+        async with limit:
+            return await loop.run_in_executor(executor, partial(function, *callArgs))
+
+    try:
+        connectArgs = argparse.Namespace(host=host, user=endpoint['user'], port=endpoint.get('port', 443),
+                                         cert_check_skip=endpoint.get('cert_check_skip', False),
+                                         password=endpoint['password'], session_cache=args.session_cache)
+        si, content = await Call(Login, connectArgs)
+        if not si:
+            print('ERROR: Could not connect to {} using the specified username and password'.format(host),
+                  file=sys.stderr)
+            return
+        vchtime = await Call(si.CurrentTime)
+        perf_dict = await Call(GetPerfDict, content, [counter_name for counter_name, instance in VM_COUNTERS],
+                               host, None if args.no_counter_cache else PERF_CACHE_DIR)
+        uncollected = await Call(UncollectedCounters, content, perf_dict,
+                                 [counter_name for counter_name, instance in VM_COUNTERS], args.interval)
+        if uncollected:
+            print('{} on {}'.format(UncollectedNote(uncollected, args.interval), host), file=sys.stderr)
+
+        vms = []
+        for vm in await Call(FindVms, content, args.vm):
+            if vm.powerState == "poweredOn":
+                vms.append(vm.moref)
+            else:
+                print('ERROR: Problem connecting to Virtual Machine.  {} on {} is likely powered off or '
+                      'suspended'.format(vm.name, host), file=sys.stderr)
+        properties = await Call(PrefetchProperties, content, vms, VM_PROPERTIES, HOST_PROPERTIES)
+
+        metricIds = VmMetricIds(perf_dict)
+        chunkSize = await Call(GetChunkSize, content, args.chunk_size, len(metricIds))
+        chunks = [vms[chunkStart:chunkStart + chunkSize] for chunkStart in range(0, len(vms), chunkSize)]
+        sessionPool = SessionPool([content])
+        store = SampleStore(args.store, content.about.instanceUuid or host) if args.store else None
+
+        vmErrors = {}
+
+        async def CollectChunk(chunk):
+            try:
+                chunkMetrics = await Call(CollectVms, sessionPool, vchtime, metricIds, chunk, args.interval,
+                                          perf_dict, store, vmErrors)
+                return chunk, chunkMetrics, None
+            except Exception as e:
+                return chunk, {}, getattr(e, 'msg', None) or str(e)
+
+        for completed in asyncio.as_completed([CollectChunk(chunk) for chunk in chunks]):
+            chunk, chunkMetrics, error = await completed
+            for vm in chunk:
+                vmname = properties[vm].name
+                if error or vm in vmErrors:
+                    print('ERROR: Could not get performance results for {} on {}: {}'.format(
+                        vmname, host, error or vmErrors[vm]), file=sys.stderr)
+                elif not chunkMetrics.get(vm):
+                    print('ERROR: Performance results empty for {} on {}.  TIP: Check time drift on source and '
+                          'vCenter server'.format(vmname, host), file=sys.stderr)
+                else:
+                    try:
+                        writer.Write(VmRecord(vm, content, vchtime, args.interval, perf_dict, properties,
+                                              chunkMetrics[vm], vcenter=host))
+                    except Exception as e:
+                        print('ERROR: Could not report on {} on {}: {}'.format(vmname, host,
+                                                                               getattr(e, 'msg', None) or str(e)),
+                              file=sys.stderr)
+    except Exception as e:
+        print('ERROR: Could not report on {}: {}'.format(host, getattr(e, 'msg', None) or str(e)), file=sys.stderr)
+
+
+async def SweepEndpoints(endpoints, args, writer):
+    # All vCenters run at once, so the sweep takes about as long as the slowest one
+    concurrency = max(1, min(args.workers, SESSION_CONCURRENCY))
+    with ThreadPoolExecutor(max_workers=len(endpoints) * concurrency) as executor:
+        await asyncio.gather(*[SweepEndpoint(endpoint, args, executor, writer) for endpoint in endpoints])
+
+
+def main():
+    args = GetArgs()
+    vmstats.PAGE_SIZE = args.page_size
+    if args.profile:
+        PROFILE.Install(trace=bool(args.profile_trace))
+    writer = ReportWriter(args.format)
+    try:
+        return Report(args, writer)
+    finally:
+        writer.Close()
+        if args.profile:
+            PROFILE.Summary(sys.stderr)
+            if args.profile_trace:
+                PROFILE.WriteTrace(args.profile_trace)
+
+
+def Report(args, writer):
+    if args.endpoints:
+        import viconfig
+        endpoints = viconfig.GetEndpoints()
+        for endpoint in endpoints:
+            if not endpoint.get('password'):
+                endpoint['password'] = getpass.getpass(prompt="Enter password for host {} and user {}: ".format(
+                    endpoint['host'], endpoint['user']))
+        asyncio.run(SweepEndpoints(endpoints, args, writer))
+        return 0
+
+    try:
+        vmnames = args.vm
+        si, content = Login(args)
+        if not si:
+            print('Could not connect to the specified host using specified username and password', file=sys.stderr)
             return -1
 
-        atexit.register(Disconnect, si)
-        content = si.RetrieveContent()
-        # Get vCenter date and time for use as baseline when querying for counters
-        vchtime = si.CurrentTime()
-
-        # Get all the performance counters
-        perf_dict = {}
-        perfList = content.perfManager.perfCounter
-        for counter in perfList:
-            counter_full = "{}.{}.{}".format(counter.groupInfo.key, counter.nameInfo.key, counter.rollupType)
-            perf_dict[counter_full] = counter.key
-
-        retProps = GetProperties(content, [vim.VirtualMachine], ['name', 'runtime.powerState'], vim.VirtualMachine)
-
-        #Find VM supplied as arg and use Managed Object Reference (moref) for the PrintVmInfo
-        for vm in retProps:
-            if (vm['name'] in vmnames) and (vm['runtime.powerState'] == "poweredOn"):
-                PrintVmInfo(vm['moref'], content, vchtime, args.interval, perf_dict)
-            elif vm['name'] in vmnames:
-                print('ERROR: Problem connecting to Virtual Machine.  {} is likely powered off or suspended'.format(vm['name']))
+        with PROFILE.Stage('connect'):
+            # Get vCenter date and time for use as baseline when querying for counters
+            vchtime = si.CurrentTime()
+
+        # Get the performance counters, from the local cache when it matches this vCenter
+        counters = VM_COUNTERS + HOST_COUNTERS if args.esxi or args.cluster else VM_COUNTERS
+        with PROFILE.Stage('counters'):
+            perf_dict = GetPerfDict(content, [counter_name for counter_name, instance in counters], args.host,
+                                    None if args.no_counter_cache else PERF_CACHE_DIR)
+            uncollected = UncollectedCounters(content, perf_dict, [counter_name for counter_name, instance in counters],
+                                              args.interval)
+        if uncollected:
+            print(UncollectedNote(uncollected, args.interval), file=sys.stderr)
+        store = SampleStore(args.store, content.about.instanceUuid or args.host) if args.store else None
+
+        if args.top:
+            with PROFILE.Stage('top'):
+                return TopVms(content, vchtime, perf_dict, args, writer, store)
+        if args.esxi or args.cluster:
+            with PROFILE.Stage('rollup'):
+                return RollupHosts(content, vchtime, perf_dict, args, writer, store)
+        if args.exporter:
+            return ServeExporter(si, content, vchtime, perf_dict, args)
+
+        #Find VM supplied as arg and use Managed Object Reference (moref) for the VmRecord
+        vms = []
+        with PROFILE.Stage('find_vms'):
+            found = FindVms(content, vmnames)
+        for vm in found:
+            if vm.powerState == "poweredOn":
+                vms.append(vm.moref)
+            else:
+                print('ERROR: Problem connecting to Virtual Machine.  {} is likely powered off or suspended'.format(vm.name), file=sys.stderr)
+
+        #Get every property the report needs for the VMs and their hosts up front
+        with PROFILE.Stage('properties'):
+            properties = PrefetchProperties(content, vms, VM_PROPERTIES, HOST_PROPERTIES)
+        PROFILE.Names(properties)
+
+        if args.watch:
+            with PROFILE.Stage('watch'):
+                WatchVms(si, content, vchtime, perf_dict, vms, properties, args, writer)
+            return 0
+
+        #Query the perf counters for many VMs per QueryPerf call, spreading the chunks over the workers
+        workers = max(1, args.workers)
+        metricIds = VmMetricIds(perf_dict)
+        with PROFILE.Stage('collect'):
+            chunkSize = GetChunkSize(content, args.chunk_size, len(metricIds))
+        if workers > 1:
+            chunkSize = max(1, min(chunkSize, -(-len(vms) // workers)))
+        chunks = [vms[chunkStart:chunkStart + chunkSize] for chunkStart in range(0, len(vms), chunkSize)]
+
+        sessions = [content]
+        for extraSession in range(1, -(-workers // SESSION_CONCURRENCY)):
+            extraSi, extraContent = Login(args, extraSession)
+            if not extraSi:
+                break
+            sessions.append(extraContent)
+        sessionPool = SessionPool(sessions)
+
+        #Report on the chunks in the order the VMs were given, each as soon as it and the ones before it are done
+        with ThreadPoolExecutor(max_workers=workers) as executor, PROFILE.Stage('collect'):
+            vmErrors = {}
+            futures = [executor.submit(CollectVms, sessionPool, vchtime, metricIds, chunk, args.interval, perf_dict,
+                                       store, vmErrors) for chunk in chunks]
+            for chunk, future in zip(chunks, futures):
+                try:
+                    chunkMetrics = future.result()
+                except Exception as e:
+                    chunkMetrics = {}
+                    error = getattr(e, 'msg', None) or str(e)
+                    for vm in chunk:
+                        print('ERROR: Could not get performance results for {}: {}'.format(
+                            properties[vm].name, error), file=sys.stderr)
+                    continue
+                for vm in chunk:
+                    if vm in vmErrors:
+                        print('ERROR: Could not get performance results for {}: {}'.format(
+                            properties[vm].name, vmErrors[vm]), file=sys.stderr)
+                        continue
+                    if not chunkMetrics.get(vm):
+                        print('ERROR: Performance results empty for {}.  TIP: Check time drift on source and '
+                              'vCenter server'.format(properties[vm].name), file=sys.stderr)
+                        continue
+                    try:
+                        with PROFILE.Stage('render', [vm]):
+                            writer.Write(VmRecord(vm, content, vchtime, args.interval, perf_dict, properties,
+                                                  chunkMetrics[vm]))
+                    except Exception as e:
+                        print('ERROR: Could not report on {}: {}'.format(properties[vm].name,
+                                                                         getattr(e, 'msg', None) or str(e)),
+                              file=sys.stderr)
 
     except vmodl.MethodFault as e:
-        print('Caught vmodl fault : ' + e.msg)
+        print('Caught vmodl fault : ' + e.msg, file=sys.stderr)
         return -1
     except Exception as e:
-        print('Caught exception : ' + str(e))
+        print('Caught exception : ' + str(e), file=sys.stderr)
         return -1
 
     return 0
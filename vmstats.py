@@ -0,0 +1,649 @@
+#!/usr/bin/env python
+
+"""
+Code shared by py-vminfo.py and py-vminfo-web.py: the perf counter map, the property and perf queries, the snapshots
+the reports are built from, the statistics reduction and the sample store.
+"""
+
+from pyVmomi import vmodl, vim
+import numpy as np
+from datetime import timedelta, datetime, timezone
+from socketserver import ThreadingMixIn
+from wsgiref.simple_server import WSGIServer
+
+import fnmatch
+import json
+import math
+import os
+import threading
+import warnings
+
+# Counters queried for each VM and the instance to request for each of them
+VM_COUNTERS = [('cpu.ready.summation', ''),
+               ('cpu.usage.average', ''),
+               ('mem.active.average', ''),
+               ('mem.shared.average', ''),
+               ('mem.vmmemctl.average', ''),
+               ('mem.swapped.average', ''),
+               ('datastore.numberReadAveraged.average', '*'),
+               ('datastore.numberWriteAveraged.average', '*'),
+               ('datastore.totalReadLatency.average', '*'),
+               ('datastore.totalWriteLatency.average', '*'),
+               ('net.transmitted.average', ''),
+               ('net.received.average', '')]
+
+# How the instances of a counter are combined before reducing over time.  Counters not listed are summed, so the
+# IOPS of every datastore add up, while latency is that of the slowest datastore
+INSTANCE_ROLLUP = {'datastore.totalReadLatency.average': 'max',
+                   'datastore.totalWriteLatency.average': 'max'}
+
+# Property paths read for each VM and for the host it is running on
+VM_PROPERTIES = ['summary.config', 'summary.runtime.host', 'resourceConfig.cpuAllocation',
+                 'resourceConfig.memoryAllocation', 'config.hardware.device', 'rootSnapshot']
+HOST_PROPERTIES = ['name', 'summary.hardware', 'summary.quickStats']
+
+# vCenter's statistics levels as (sampling period in seconds, minutes of samples kept at the default settings).  The
+# 20s realtime samples only go back an hour, longer windows come from the rollups
+STATS_INTERVALS = [(20, 60), (300, 24 * 60), (1800, 7 * 24 * 60), (7200, 30 * 24 * 60), (86400, 365 * 24 * 60)]
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+# Objects per RetrievePropertiesEx or WaitForUpdatesEx page, set by --page-size or page_size in viconfig.py.  0 leaves
+# the page size to vCenter
+PAGE_SIZE = 0
+
+# Where the perf counter name to key map is cached between runs
+PERF_CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'python-vmstats')
+
+
+class PerfQueryError(Exception):
+    pass
+
+
+def SamplePeriod(interval):
+    # The finest statistics level that still holds the whole window, so a week is read as 336 30 minute samples
+    # rather than 30240 20s ones that vCenter no longer has anyway
+    for samplingPeriod, length in STATS_INTERVALS:
+        if interval <= length:
+            return samplingPeriod
+    return STATS_INTERVALS[-1][0]
+
+
+def QueryWindow(vchtime, interval):
+    # Start and end of the window to average over, the level to read it from and how many samples that is
+    samplingPeriod = SamplePeriod(interval)
+    startTime = vchtime - timedelta(minutes=(interval + 1))
+    endTime = vchtime - timedelta(minutes=1)
+    return startTime, endTime, samplingPeriod, max(1, interval * 60 // samplingPeriod)
+
+
+def BuildQuery(content, vchtime, metricIds, vm, interval):
+    perfManager = content.perfManager
+    startTime, endTime, samplingPeriod, maxSample = QueryWindow(vchtime, interval)
+    query = vim.PerformanceManager.QuerySpec(intervalId=samplingPeriod, entity=vm, metricId=metricIds,
+                                             startTime=startTime, endTime=endTime, maxSample=maxSample)
+    perfResults = perfManager.QueryPerf(querySpec=[query])
+    if perfResults:
+        return perfResults
+    else:
+        raise PerfQueryError('\n'.join([
+            'ERROR: Performance results empty.  TIP: Check time drift on source and vCenter server',
+            'Troubleshooting info:',
+            'vCenter/host date and time: {}'.format(vchtime),
+            'Start perf counter time   :  {}'.format(startTime),
+            'End perf counter time     :  {}'.format(endTime),
+            str(query)]))
+
+
+def VmMetricIds(perf_dict, counters=VM_COUNTERS):
+    # One MetricId per counter in VM_COUNTERS so the whole set can go in a single QuerySpec
+    return [vim.PerformanceManager.MetricId(counterId=StatCheck(perf_dict, counter_name), instance=instance)
+            for counter_name, instance in counters]
+
+
+def SplitPerfResults(entityMetric):
+    # Group the sample series of a PerfEntityMetric by counterId, keeping the order vCenter returned the
+    # instances in so that stats[counterId][0] is the series a single-counter query would have returned
+    stats = {}
+    for series in entityMetric.value:
+        stats.setdefault(series.id.counterId, []).append(series.value)
+    return stats
+
+
+def ReduceStats(vmStats, perf_dict, counters=VM_COUNTERS):
+    """
+    Reduce the perf series of many VMs (or hosts, with HOST_COUNTERS) in one vectorised pass.  vmStats is a list of
+    SplitPerfResults style dicts and the result is a matching list of {counter name: {'mean', 'max', 'p95', 'p99'}}.
+    The instances of each counter are combined sample by sample first, using INSTANCE_ROLLUP.
+    """
+    if not vmStats:
+        return []
+    counterNames = [counter_name for counter_name, instance in counters]
+    counterIds = [StatCheck(perf_dict, counter_name) for counter_name in counterNames]
+    seriesLists = [[stats.get(counterId, []) for counterId in counterIds] for stats in vmStats]
+    instances = max([len(seriesList) for vmSeries in seriesLists for seriesList in vmSeries] + [1])
+    samples = max([len(series) for vmSeries in seriesLists for seriesList in vmSeries for series in seriesList] + [1])
+
+    # VMs x counters x instances x samples, with series right aligned so the latest samples line up
+    data = np.full((len(vmStats), len(counterIds), instances, samples), np.nan)
+    for vmIndex, vmSeries in enumerate(seriesLists):
+        for counterIndex, seriesList in enumerate(vmSeries):
+            for instanceIndex, series in enumerate(seriesList):
+                if len(series):
+                    data[vmIndex, counterIndex, instanceIndex, samples - len(series):] = series
+
+    present = ~np.isnan(data)
+    rollupMax = np.array([INSTANCE_ROLLUP.get(counter_name) == 'max' for counter_name in counterNames])
+    combined = np.where(rollupMax[None, :, None], np.where(present, data, -np.inf).max(axis=2),
+                        np.where(present, data, 0).sum(axis=2))
+    combined[~present.any(axis=2)] = np.nan
+
+    with warnings.catch_warnings():
+        # VMs missing a counter leave all-NaN rows, which reduce to NaN
+        warnings.simplefilter('ignore', RuntimeWarning)
+        mean = np.nanmean(combined, axis=2)
+        maximum = np.nanmax(combined, axis=2)
+        p95, p99 = np.nanpercentile(combined, [95, 99], axis=2)
+
+    vmMetrics = []
+    for vmIndex in range(len(vmStats)):
+        vmMetrics.append(dict((counter_name, {'mean': mean[vmIndex, counterIndex],
+                                              'max': maximum[vmIndex, counterIndex],
+                                              'p95': p95[vmIndex, counterIndex],
+                                              'p99': p99[vmIndex, counterIndex]})
+                              for counterIndex, counter_name in enumerate(counterNames)))
+    return vmMetrics
+
+
+def ToEpoch(timestamp):
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return int((timestamp - EPOCH).total_seconds())
+
+
+class SampleStore(object):
+    """
+    Local store of the samples collected from one vCenter, so a window that was already fetched doesn't have
+    to be queried again.  Each VM's samples for a day go in one fixed-width record file kept in timestamp order,
+    <root>/<vCenter>/<YYYYMMDD>/<VM moref>.dat, so a window is found with a binary search of the memory mapped
+    file rather than a scan.  Samples from the historical levels go in <VM moref>.<sampling period>s.dat next to it.
+    """
+
+    RECORD = np.dtype([('timestamp', '<i8'), ('counterId', '<i4'), ('instance', 'S40'), ('value', '<i8')])
+
+    def __init__(self, root, vcenter):
+        self.root = os.path.join(root, vcenter)
+        self.lock = threading.Lock()
+
+    def Path(self, day, vmId, samplingPeriod=20):
+        if samplingPeriod != 20:
+            return os.path.join(self.root, day.strftime('%Y%m%d'), '{}.{}s.dat'.format(vmId, samplingPeriod))
+        return os.path.join(self.root, day.strftime('%Y%m%d'), '{}.dat'.format(vmId))
+
+    def Records(self, path):
+        # A record still being appended by another process is left off the end
+        count = os.path.getsize(path) // self.RECORD.itemsize if os.path.exists(path) else 0
+        if not count:
+            return np.zeros(0, dtype=self.RECORD)
+        return np.memmap(path, dtype=self.RECORD, mode='r', shape=(count,))
+
+    def Append(self, entityMetric):
+        timestamps = [ToEpoch(sampleInfo.timestamp) for sampleInfo in entityMetric.sampleInfo or []]
+        samplingPeriod = entityMetric.sampleInfo[0].interval if entityMetric.sampleInfo else 20
+        days = {}
+        for sample, timestamp in enumerate(timestamps):
+            days.setdefault((EPOCH + timedelta(seconds=timestamp)).date(), []).append(sample)
+        for day, samples in days.items():
+            records = []
+            for series in entityMetric.value:
+                daySamples = [sample for sample in samples if sample < len(series.value)]
+                seriesRecords = np.zeros(len(daySamples), dtype=self.RECORD)
+                seriesRecords['timestamp'] = [timestamps[sample] for sample in daySamples]
+                seriesRecords['counterId'] = series.id.counterId
+                seriesRecords['instance'] = series.id.instance
+                seriesRecords['value'] = [series.value[sample] for sample in daySamples]
+                records.append(seriesRecords)
+            if records:
+                self.Write(self.Path(day, entityMetric.entity._moId, samplingPeriod), np.concatenate(records))
+
+    def Write(self, path, records):
+        # Samples newer than the last stored one are appended, anything else is merged in and the file rewritten,
+        # so the file stays in timestamp order and a sample that is already there isn't stored twice
+        records = records[np.argsort(records['timestamp'], kind='stable')]
+        with self.lock:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            stored = self.Records(path)
+            if not len(stored) or records['timestamp'][0] > stored['timestamp'][-1]:
+                with open(path, 'ab') as dataFile:
+                    records.tofile(dataFile)
+                return
+            merged = np.concatenate([np.array(stored), records])
+            del stored
+            # Stable, so of two records for the same sample the one already stored comes first and is kept
+            merged = merged[np.lexsort((merged['instance'], merged['counterId'], merged['timestamp']))]
+            keep = np.ones(len(merged), dtype=bool)
+            keep[1:] = ((merged['timestamp'][1:] != merged['timestamp'][:-1]) |
+                        (merged['counterId'][1:] != merged['counterId'][:-1]) |
+                        (merged['instance'][1:] != merged['instance'][:-1]))
+            with open(path + '.tmp', 'wb') as dataFile:
+                merged[keep].tofile(dataFile)
+            os.replace(path + '.tmp', path)
+
+    def Read(self, counterIds, vms, startTime, endTime, samplingPeriod=20):
+        # Samples in (startTime, endTime] as {vm moref id: {counterId: {instance: {timestamp: value}}}}
+        start = ToEpoch(startTime)
+        end = ToEpoch(endTime)
+        stored = {}
+        for vm in vms:
+            day = (EPOCH + timedelta(seconds=start)).date()
+            while day <= (EPOCH + timedelta(seconds=end)).date():
+                records = self.Records(self.Path(day, vm._moId, samplingPeriod))
+                timestamps = records['timestamp']
+                selected = records[np.searchsorted(timestamps, start, side='right'):
+                                   np.searchsorted(timestamps, end, side='right')]
+                for record in selected[np.isin(selected['counterId'], counterIds)]:
+                    vmSeries = stored.setdefault(vm._moId, {}).setdefault(int(record['counterId']), {})
+                    vmSeries.setdefault(record['instance'].decode(), {})[int(record['timestamp'])] = \
+                        int(record['value'])
+                del records, timestamps, selected
+                day += timedelta(days=1)
+        return stored
+
+    @staticmethod
+    def Stats(vmStored):
+        # Same shape as SplitPerfResults, each series in timestamp order
+        stats = {}
+        for counterId, instances in vmStored.items():
+            for instance in sorted(instances):
+                samples = instances[instance]
+                stats.setdefault(counterId, []).append([samples[timestamp] for timestamp in sorted(samples)])
+        return stats
+
+    @staticmethod
+    def Coverage(vmStored):
+        # First and last timestamps every stored counter instance has, or None if nothing is stored
+        if not vmStored:
+            return None, None
+        series = [samples for instances in vmStored.values() for samples in instances.values() if samples]
+        if not series:
+            return None, None
+        return max(min(samples) for samples in series), min(max(samples) for samples in series)
+
+
+def FetchStoredStats(content, store, vchtime, metricIds, vms, interval):
+    # Serve the window from the store where it already holds the samples, and only ask vCenter for the ranges
+    # missing before the first and after the last stored sample
+    startTime, endTime, samplingPeriod, maxSample = QueryWindow(vchtime, interval)
+    counterIds = sorted(set(metricId.counterId for metricId in metricIds))
+    stored = store.Read(counterIds, vms, startTime, endTime, samplingPeriod)
+    querySpecs = []
+    for vm in vms:
+        ranges = []
+        first, last = store.Coverage(stored.get(vm._moId))
+        if first is None:
+            ranges.append((startTime, endTime))
+        else:
+            if first > ToEpoch(startTime) + 2 * samplingPeriod:
+                ranges.append((startTime, EPOCH + timedelta(seconds=first)))
+            if last < ToEpoch(endTime) - samplingPeriod:
+                ranges.append((EPOCH + timedelta(seconds=last), endTime))
+        querySpecs += [vim.PerformanceManager.QuerySpec(intervalId=samplingPeriod, entity=vm, metricId=metricIds,
+                                                        startTime=queryStart, endTime=queryEnd, maxSample=maxSample)
+                       for queryStart, queryEnd in ranges]
+    if querySpecs:
+        for entityMetric in content.perfManager.QueryPerf(querySpec=querySpecs):
+            store.Append(entityMetric)
+        stored = store.Read(counterIds, vms, startTime, endTime, samplingPeriod)
+    return dict((vm, store.Stats(stored.get(vm._moId, {}))) for vm in vms)
+
+
+def SampleNote(interval):
+    # Realtime reports read as they always have, longer ones say which rollup they were averaged from
+    samplingPeriod = SamplePeriod(interval)
+    if samplingPeriod == 20:
+        return ''
+    if samplingPeriod >= 3600:
+        return ' of {} hour samples'.format(samplingPeriod // 3600)
+    return ' of {} minute samples'.format(samplingPeriod // 60)
+
+
+def Figure(interval, template, *values):
+    # Counters vCenter doesn't keep at the statistics level a long interval is read from have no samples at all
+    if any(value is None or math.isnan(value) for value in values):
+        return 'Not collected at this statistics level' if SamplePeriod(interval) != 20 else 'No samples'
+    return template.format(*values)
+
+
+def StatCheck(perf_dict, counter_name):
+    counter_key = perf_dict[counter_name]
+    return counter_key
+
+
+def UncollectedCounters(content, perf_dict, counter_names, interval):
+    # Rollups only keep the counters at or below the statistics level of their historical interval, and the
+    # default level 1 drops several the report reads (net.transmitted, mem.swapped, ...)
+    samplingPeriod = SamplePeriod(interval)
+    if samplingPeriod == 20:
+        return []
+    levels = [historical.level for historical in content.perfManager.historicalInterval
+              if historical.samplingPeriod == samplingPeriod and historical.enabled]
+    counterIds = [perf_dict[counter_name] for counter_name in counter_names if counter_name in perf_dict]
+    if not levels or not counterIds:
+        return []
+    counters = content.perfManager.QueryPerfCounter(counterId=counterIds)
+    return sorted(set(CounterName(counter) for counter in counters if (counter.level or 0) > levels[0]))
+
+
+def CounterName(counter):
+    return "{}.{}.{}".format(counter.groupInfo.key, counter.nameInfo.key, counter.rollupType)
+
+
+def GetPerfDict(content, counter_names, host, cache_dir):
+    # Counter keys can change between vCenter builds, so the cache file is per vCenter instance and only
+    # trusted when it was written for the same API version and build
+    about = content.about
+    version = '{} {}'.format(about.apiVersion, about.build)
+    perf_dict = None
+    cached = {}
+    if cache_dir:
+        cache_file = os.path.join(cache_dir, 'perf-counters-{}.json'.format(about.instanceUuid or host))
+        try:
+            with open(cache_file) as cache:
+                cached = json.load(cache)
+        except (IOError, OSError, ValueError):
+            cached = {}
+    cached_counters = cached.get('counters', {})
+    if all(counter_name in cached_counters for counter_name in counter_names):
+        if cached.get('version') == version:
+            return cached_counters
+        # Different build - check just the counters we need with QueryPerfCounter before falling back to the
+        # full catalog
+        counterIds = [cached_counters[counter_name] for counter_name in counter_names]
+        counters = content.perfManager.QueryPerfCounter(counterId=counterIds)
+        if sorted(CounterName(counter) for counter in counters) == sorted(counter_names):
+            perf_dict = dict((CounterName(counter), counter.key) for counter in counters)
+
+    if perf_dict is None:
+        # Get all the performance counters
+        perf_dict = {}
+        perfList = content.perfManager.perfCounter
+        for counter in perfList:
+            perf_dict[CounterName(counter)] = counter.key
+
+    if cache_dir:
+        try:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            with open(cache_file, 'w') as cache:
+                json.dump({'version': version, 'counters': perf_dict}, cache)
+        except (IOError, OSError):
+            pass
+    return perf_dict
+
+
+class DiskSnapshot(object):
+    """
+    One virtual disk of a VM.
+    """
+    __slots__ = ('label', 'capacityKb', 'thin', 'fileName')
+
+    def __init__(self, device):
+        self.label = device.deviceInfo.label
+        self.capacityKb = device.capacityInKB
+        self.thin = getattr(device.backing, 'thinProvisioned', None)
+        self.fileName = getattr(device.backing, 'fileName', None)
+
+
+class NicSnapshot(object):
+    """
+    One network adapter of a VM.
+    """
+    __slots__ = ('label', 'network', 'mac')
+
+    def __init__(self, device):
+        self.label = device.deviceInfo.label
+        self.network = device.deviceInfo.summary
+        self.mac = device.macAddress
+
+
+class VmSnapshot(object):
+    """
+    The values the reports use from one VM's properties, read straight out of the property collector results.  Only
+    these are kept, so a big inventory costs a few small objects per VM instead of a dictionary of full pyVmomi data
+    objects and device lists.  Properties that weren't retrieved are None.
+    """
+    __slots__ = ('moref', 'name', 'powerState', 'annotation', 'guestFullName', 'vmPathName', 'numCpu', 'memorySizeMB',
+                 'host', 'cpuLimit', 'cpuReservation', 'memLimit', 'memReservation', 'disks', 'nics', 'hasSnapshot',
+                 'cpuUsage', 'cpuDemand', 'swappedMemory')
+
+    def __init__(self, moref, propSet=()):
+        self.moref = moref
+        self.name = self.powerState = self.annotation = self.guestFullName = self.vmPathName = None
+        self.numCpu = self.memorySizeMB = self.host = None
+        self.cpuLimit = self.cpuReservation = self.memLimit = self.memReservation = None
+        self.disks = self.nics = ()
+        self.hasSnapshot = False
+        self.cpuUsage = self.cpuDemand = self.swappedMemory = None
+        for prop in propSet:
+            self.Set(prop.name, prop.val)
+
+    def Set(self, path, value):
+        if path == 'name':
+            self.name = value
+        elif path == 'runtime.powerState':
+            self.powerState = value
+        elif path == 'summary.runtime.host':
+            self.host = value
+        elif path == 'rootSnapshot':
+            self.hasSnapshot = bool(value)
+        elif value is None:
+            return
+        elif path == 'summary.config':
+            self.name = value.name
+            self.annotation = value.annotation
+            self.guestFullName = value.guestFullName
+            self.vmPathName = value.vmPathName
+            self.numCpu = value.numCpu
+            self.memorySizeMB = value.memorySizeMB
+        elif path == 'resourceConfig.cpuAllocation':
+            self.cpuLimit = value.limit
+            self.cpuReservation = value.reservation
+        elif path == 'resourceConfig.memoryAllocation':
+            self.memLimit = value.limit
+            self.memReservation = value.reservation
+        elif path == 'config.hardware.device':
+            self.disks = tuple(DiskSnapshot(device) for device in value if 2000 <= device.key < 3000)
+            self.nics = tuple(NicSnapshot(device) for device in value if 4000 <= device.key < 5000)
+        elif path == 'summary.quickStats':
+            self.cpuUsage = value.overallCpuUsage
+            self.cpuDemand = value.overallCpuDemand
+            self.swappedMemory = value.swappedMemory
+
+
+class HostSnapshot(object):
+    """
+    The values the reports use from one ESXi host's properties.
+    """
+    __slots__ = ('moref', 'name', 'cpuModel', 'cpuMhz', 'numCpuPkgs', 'numCpuCores', 'memorySize', 'cpuUsage',
+                 'memoryUsage', 'vms')
+
+    def __init__(self, moref, propSet=()):
+        self.moref = moref
+        self.name = self.cpuModel = self.cpuMhz = self.numCpuPkgs = self.numCpuCores = self.memorySize = None
+        self.cpuUsage = self.memoryUsage = None
+        self.vms = ()
+        for prop in propSet:
+            self.Set(prop.name, prop.val)
+
+    def Set(self, path, value):
+        if path == 'name':
+            self.name = value
+        elif value is None:
+            return
+        elif path == 'summary.hardware':
+            self.cpuModel = value.cpuModel
+            self.cpuMhz = value.cpuMhz
+            self.numCpuPkgs = value.numCpuPkgs
+            self.numCpuCores = value.numCpuCores
+            self.memorySize = value.memorySize
+        elif path == 'summary.quickStats':
+            self.cpuUsage = value.overallCpuUsage
+            self.memoryUsage = value.overallMemoryUsage
+        elif path == 'vm':
+            self.vms = tuple(value)
+
+
+class ClusterSnapshot(object):
+    """
+    Name and hosts of one cluster.
+    """
+    __slots__ = ('moref', 'name', 'hosts')
+
+    def __init__(self, moref, propSet=()):
+        self.moref = moref
+        self.name = None
+        self.hosts = ()
+        for prop in propSet:
+            if prop.name == 'name':
+                self.name = prop.val
+            elif prop.name == 'host':
+                self.hosts = tuple(prop.val or ())
+
+
+def NewSnapshot(moref, propSet):
+    if isinstance(moref, vim.VirtualMachine):
+        return VmSnapshot(moref, propSet)
+    if isinstance(moref, vim.HostSystem):
+        return HostSnapshot(moref, propSet)
+    return ClusterSnapshot(moref, propSet)
+
+
+def GetProperties(content, viewType, props, specType):
+    # Build a view and get basic properties for all Virtual Machines
+    objView = content.viewManager.CreateContainerView(content.rootFolder, viewType, True)
+    tSpec = vim.PropertyCollector.TraversalSpec(name='tSpecName', path='view', skip=False, type=vim.view.ContainerView)
+    pSpec = vim.PropertyCollector.PropertySpec(all=False, pathSet=props, type=specType)
+    oSpec = vim.PropertyCollector.ObjectSpec(obj=objView, selectSet=[tSpec], skip=False)
+    pfSpec = vim.PropertyCollector.FilterSpec(objectSet=[oSpec], propSet=[pSpec], reportMissingObjectsInResults=False)
+    gpOutput = RetrieveProperties(content, pfSpec)
+    objView.Destroy()
+    return gpOutput
+
+
+def PrefetchProperties(content, vms, vmProps, hostProps):
+    # Get the properties for the supplied VMs and the hosts they run on in a single RetrievePropertiesEx pass
+    # by following runtime.host from each VM, returning a dictionary of VmSnapshot and HostSnapshot keyed by moref
+    if not vms:
+        # A FilterSpec needs at least one object
+        return {}
+    tSpec = vim.PropertyCollector.TraversalSpec(name='tSpecHost', path='runtime.host', skip=False,
+                                                type=vim.VirtualMachine)
+    vmSpec = vim.PropertyCollector.PropertySpec(all=False, pathSet=vmProps, type=vim.VirtualMachine)
+    hostSpec = vim.PropertyCollector.PropertySpec(all=False, pathSet=hostProps, type=vim.HostSystem)
+    oSpecs = [vim.PropertyCollector.ObjectSpec(obj=vm, selectSet=[tSpec], skip=False) for vm in vms]
+    pfSpec = vim.PropertyCollector.FilterSpec(objectSet=oSpecs, propSet=[vmSpec, hostSpec],
+                                              reportMissingObjectsInResults=False)
+    pfOutput = {}
+    for snapshot in RetrieveProperties(content, pfSpec):
+        pfOutput[snapshot.moref] = snapshot
+    return pfOutput
+
+
+def RetrieveProperties(content, pfSpec):
+    # Each page is read into snapshots as it arrives, so only one page of raw pyVmomi objects is held at a time
+    retOptions = vim.PropertyCollector.RetrieveOptions(maxObjects=PAGE_SIZE or None)
+    gpOutput = []
+    retProps = content.propertyCollector.RetrievePropertiesEx(specSet=[pfSpec], options=retOptions)
+    while retProps:
+        gpOutput += [NewSnapshot(eachProp.obj, eachProp.propSet) for eachProp in retProps.objects]
+        if not retProps.token:
+            break
+        retProps = content.propertyCollector.ContinueRetrievePropertiesEx(token=retProps.token)
+    return gpOutput
+
+
+def SplitVmNames(vmnames):
+    return [vmname.strip() for vmname in vmnames.split(',') if vmname.strip()]
+
+
+def IsGlob(vmname):
+    return any(char in vmname for char in '*?[')
+
+
+def MatchNames(byName, vmname):
+    # Exact names are dictionary lookups, only globs need to look at every name
+    if IsGlob(vmname):
+        matches = sorted(fnmatch.filter([name for name in byName if name], vmname))
+    else:
+        matches = [vmname]
+    return [vm for name in matches for vm in byName.get(name, [])]
+
+
+class VmIndex(object):
+    """
+    VM name to moref index for the whole inventory.  It is filled from a property filter on its own
+    PropertyCollector and kept current by Update, which only fetches what changed since the last version token.
+    """
+
+    def __init__(self, content):
+        self.version = ''
+        self.vms = {}
+        self.names = {}
+        self.objView = content.viewManager.CreateContainerView(content.rootFolder, [vim.VirtualMachine], True)
+        self.propertyCollector = content.propertyCollector.CreatePropertyCollector()
+        tSpec = vim.PropertyCollector.TraversalSpec(name='tSpecName', path='view', skip=False,
+                                                    type=vim.view.ContainerView)
+        pSpec = vim.PropertyCollector.PropertySpec(all=False, pathSet=['name', 'runtime.powerState'],
+                                                   type=vim.VirtualMachine)
+        oSpec = vim.PropertyCollector.ObjectSpec(obj=self.objView, selectSet=[tSpec], skip=True)
+        pfSpec = vim.PropertyCollector.FilterSpec(objectSet=[oSpec], propSet=[pSpec],
+                                                  reportMissingObjectsInResults=False)
+        self.propertyCollector.CreateFilter(spec=pfSpec, partialUpdates=False)
+        self.Update()
+
+    def Update(self):
+        # The first call returns every VM, later calls only the VMs added, removed or changed since then
+        waitOptions = vmodl.query.PropertyCollector.WaitOptions(maxWaitSeconds=0, maxObjectUpdates=PAGE_SIZE or None)
+        while True:
+            updateSet = self.propertyCollector.WaitForUpdatesEx(version=self.version, options=waitOptions)
+            if updateSet is None:
+                break
+            self.version = updateSet.version
+            for filterUpdate in updateSet.filterSet:
+                for objectUpdate in filterUpdate.objectSet:
+                    self.ApplyUpdate(objectUpdate)
+            if not updateSet.truncated:
+                break
+
+    def ApplyUpdate(self, objectUpdate):
+        moref = objectUpdate.obj
+        vm = self.vms.get(moref)
+        if vm is not None:
+            self.names[vm.name].remove(moref)
+            if not self.names[vm.name]:
+                del self.names[vm.name]
+        if objectUpdate.kind == 'leave':
+            self.vms.pop(moref, None)
+            return
+        if vm is None:
+            vm = self.vms[moref] = VmSnapshot(moref)
+        for change in objectUpdate.changeSet:
+            vm.Set(change.name, change.val if change.op == 'assign' else None)
+        self.names.setdefault(vm.name, []).append(moref)
+
+    def Find(self, vmnames):
+        found = []
+        for vmname in SplitVmNames(vmnames):
+            for moref in MatchNames(self.names, vmname):
+                if self.vms[moref] not in found:
+                    found.append(self.vms[moref])
+        return found
+
+    def Destroy(self):
+        self.propertyCollector.Destroy()
+        self.objView.Destroy()
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True